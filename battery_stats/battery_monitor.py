@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Monitors the battery burn rate of active glider deployments by polling the FMC,
+and projects when each glider's batteries will be exhausted.
+
+Each poll only processes the coulomb counter samples that arrived since the
+last one, stitching their resets and updating the rolling amphr/day rate one
+sample at a time, so the cost of keeping the rate up to date does not grow
+with the length of the deployment. The monitor reads the FMC directly and
+leaves the sensor cache of the nightly run alone.
+"""
+import sys
+import json
+import math
+import time
+import argparse
+import datetime
+import warnings
+from collections import deque
+import pandas as pd
+
+from process_battery_stats import CoulombStitcher, Deployment, all_deployments, coulomb_column, fmc_api_url, make_session, select_deployment_rows
+
+sensor_name = coulomb_column
+
+class RollingRate:
+    """Keeps the rolling rate of change of a series up to date one sample at a time,
+    using the same look back, negative rate and outlier rules as rolling_rate."""
+    def __init__(self, interval):
+        """
+        :param interval: interval in seconds over which the rate should be calculated
+        :return: null
+        """
+        self.interval = interval
+        # The look back sample followed by every sample newer than it
+        self.window = deque()
+        self.running_sum = 0.0
+        self.running_count = 0
+
+    def update(self, epoch_seconds, value):
+        """Adds a sample to the series
+        :param epoch_seconds: sample time in epoch seconds, later than any sample added before
+        :param value: sensor value of the sample
+        :return rate: the rate per day for this sample, NaN if it has less than a full
+            interval of data behind it or was rejected as negative or an outlier
+        """
+        self.window.append((epoch_seconds, value))
+        # Advance the look back sample while the next one is still at least one interval old
+        while len(self.window) > 1 and epoch_seconds - self.window[1][0] >= self.interval:
+            self.window.popleft()
+
+        look_back_seconds, look_back_value = self.window[0]
+        if epoch_seconds - look_back_seconds < self.interval:
+            return(math.nan)
+
+        rate = (value - look_back_value) / ((epoch_seconds - look_back_seconds) / 86400)
+        if rate < 0:
+            return(math.nan)
+        if self.running_count and rate > 3*(self.running_sum / self.running_count):
+            return(math.nan)
+        if rate == rate:
+            self.running_sum += rate
+            self.running_count += 1
+        return(rate)
+
+def project_exhaustion(amphr_capacity, amphr_total, rate, epoch_seconds, expected_recovery):
+    """Projects when a glider's batteries will be exhausted at its current burn rate
+    :param amphr_capacity: the max amphr capacity for the glider
+    :param amphr_total: amphr spent so far as reported by the coulomb counter
+    :param rate: current amphr/day burn rate
+    :param epoch_seconds: time of the latest sample in epoch seconds
+    :param expected_recovery: expected recovery time in epoch seconds
+    :return projected_exhaustion: projected end of battery in epoch seconds
+    :return margin_days: days between expected recovery and the projected end of battery
+    """
+    amphr_remaining = amphr_capacity - amphr_total
+    if not rate > 0:
+        return(math.inf, math.inf)
+    projected_exhaustion = epoch_seconds + (amphr_remaining / rate) * 86400
+    margin_days = (projected_exhaustion - expected_recovery) / 86400
+    return(projected_exhaustion, margin_days)
+
+class BatteryMonitor:
+    """Tracks the burn rate and projected end of battery of an active deployment."""
+    def __init__(self, deployment, row, interval=259200):
+        """
+        :param deployment: Deployment to monitor
+        :param row: the deployment's row of the deployment metadata csv
+        :param interval: interval in seconds over which the burn rate is averaged
+        :return: null
+        """
+        self.deployment = deployment
+        self.deployment_name = row['deployment_name']
+        self.expected_recovery = row['expected_recovery']
+        self.amphr_capacity = deployment.get_batt_capacity(deployment.glider.upper(), row['batt_type'])
+        # Track the coulomb counter with its resets stitched out, so a reset doesn't read as a recharge
+        self.stitcher = CoulombStitcher()
+        self.rolling_rate = RollingRate(interval)
+        self.received_epoch_seconds = -math.inf
+        self.last_epoch_seconds = -math.inf
+        self.last_amphr = math.nan
+        self.rate = math.nan
+
+    def poll(self):
+        """Pulls the latest amphr data from the FMC and adds the samples that are new since the last poll.
+        The stitcher holds back the latest sample until the next one arrives, so the status lags by one sample.
+        :return: number of new samples
+        """
+        df = self.deployment.download_sensor_df(9, self.deployment.did)
+        epoch_seconds = df['epoch_seconds'].values
+        amphr = df[sensor_name].values
+        new = (epoch_seconds > self.received_epoch_seconds).nonzero()[0]
+        for i in new:
+            for sample_seconds, stitched in self.stitcher.update(epoch_seconds[i], amphr[i]):
+                # Bad readings are left out of the rate
+                if stitched != stitched:
+                    continue
+                rate = self.rolling_rate.update(sample_seconds, stitched)
+                if rate == rate:
+                    self.rate = rate
+                self.last_epoch_seconds = sample_seconds
+                self.last_amphr = stitched
+        if len(new):
+            self.received_epoch_seconds = epoch_seconds[new[-1]]
+        return(len(new))
+
+    def status(self):
+        """Summarizes the current burn rate and projected end of battery
+        :return: dictionary describing the state of the deployment's batteries
+        """
+        projected_exhaustion, margin_days = project_exhaustion(
+            self.amphr_capacity, self.last_amphr, self.rate, self.last_epoch_seconds, self.expected_recovery)
+        return({
+            'deployment_id': int(self.deployment.did),
+            'deployment_name': self.deployment_name,
+            'epoch_seconds': float(self.last_epoch_seconds),
+            'amphr_total': float(self.last_amphr),
+            'amphr_capacity': self.amphr_capacity,
+            'rate': float(self.rate),
+            'projected_exhaustion': float(projected_exhaustion),
+            'expected_recovery': float(self.expected_recovery),
+            'margin_days': round(float(margin_days), 2),
+            })
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Monitors the battery burn rate of active glider deployments")
+    parser.add_argument('--api-url', default=fmc_api_url, help="FMC sensor API to pull data from")
+    parser.add_argument('--poll-interval', type=float, default=3600, help="seconds between polls of the FMC")
+    parser.add_argument('--margin-days', type=float, default=7,
+                        help="alert when the batteries are projected to run out less than this many days after recovery")
+    parser.add_argument('--alert-file', help="file to append alert records to as JSON lines")
+    parser.add_argument('--once', action='store_true', help="poll once and exit")
+    args = parser.parse_args(argv)
+
+    session = make_session()
+    all_deployments_df = pd.read_csv(all_deployments)
+
+    # Monitor the deployments that have not been recovered yet, out of the ones process_battery_stats processes
+    monitors = []
+    for index, row in select_deployment_rows(all_deployments_df):
+        if not pd.isna(row['end_date_epoch']):
+            continue
+        deployment = Deployment(row['glider_glider_name'], str(row['dnum']), row['deployment_id'],
+                                api_url=args.api_url, session=session, cache_dir=None)
+        monitors.append(BatteryMonitor(deployment, row))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        while True:
+            for monitor in monitors:
+                try:
+                    monitor.poll()
+                except Exception as error:
+                    print(monitor.deployment_name+" could not be polled: "+str(error), file=sys.stderr)
+                    continue
+
+                status = monitor.status()
+                print(json.dumps(status))
+                if status['margin_days'] < args.margin_days:
+                    alert = dict(status, alert="projected end of battery within "+str(args.margin_days)+
+                                 " days of expected recovery",
+                                 time=datetime.datetime.now(datetime.timezone.utc).isoformat())
+                    print(json.dumps(alert), file=sys.stderr)
+                    if args.alert_file:
+                        with open(args.alert_file, 'a') as fh:
+                            fh.write(json.dumps(alert)+"\n")
+
+            if args.once:
+                break
+            time.sleep(args.poll_interval)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the battery statistics pipeline using synthetic FMC sensor data
+served from a local stand-in for the FMC API, so they can be run without
+access to the FMC.
+
+Each benchmark runs in its own process and reports its wall time, its throughput in
+rows/s, and how much the peak RSS of the process grew during the timed call, so the
+synthetic inputs it builds beforehand aren't counted. load_to_df is compared with the
+original text splitting loader, legacy_load_to_df.
+
+Results can be saved as a baseline and later runs compared against it to catch regressions.
+Timings depend on the machine, so no baseline is kept in the repository: save one on the
+machine the comparison will run on, from the revision to compare against, e.g.
+
+    git stash  # or git checkout <revision>
+    python benchmark_battery_stats.py --save-baseline baseline.json
+    git stash pop
+    python benchmark_battery_stats.py --baseline baseline.json
+
+Usage: python benchmark_battery_stats.py [--sizes N [N ...]] [--save-baseline FILE] [--baseline FILE]
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import argparse
+import resource
+import tempfile
+import threading
+import warnings
+import multiprocessing
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+import numpy as np
+import pandas as pd
+import requests
+
+import process_battery_stats
+from process_battery_stats import Deployment
+
+sensor_name = "m_coulomb_amphr_total(amp-hrs)"
+# Column served for each FMC sensor ID by the stand-in API
+sensor_columns = {9: sensor_name, 3: 'c_climb_bpump(X)', 4: 'c_dive_bpump(X)'}
+
+def make_amphr_df(n_samples, days=365, seed=0):
+    """Builds a synthetic amphr dataframe shaped like a converted FMC sensor 9 response
+    :param n_samples: number of samples in the series
+    :param days: length of the deployment in days
+    :param seed: seed for the random number generator
+    :return df: dataframe with epoch_seconds, amphr and datetime columns
+    """
+    rng = np.random.default_rng(seed)
+    spacing = rng.exponential(days*86400 / n_samples, n_samples)
+    epoch_seconds = 1649694000 + np.cumsum(spacing)
+    amphr = np.cumsum(rng.gamma(2.0, 1.5*days / n_samples, n_samples))
+    # Add a coulomb counter reset a third of the way through the deployment
+    amphr[n_samples//3:] -= amphr[n_samples//3]
+    df = pd.DataFrame({'epoch_seconds': epoch_seconds, sensor_name: amphr})
+    df['datetime'] = pd.to_datetime(df['epoch_seconds'], unit='s')
+    return(df)
+
+def make_sensor_csv(sensor_id, n_samples, seed=0):
+    """Builds the CSV body the FMC would return for a sensor
+    :param sensor_id: FMC sensor ID, one of the keys of sensor_columns
+    :param n_samples: number of samples in the series
+    :param seed: seed for the random number generator
+    :return: CSV body as bytes
+    """
+    df = make_amphr_df(n_samples, seed=seed).drop(columns='datetime')
+    if sensor_id != 9:
+        rng = np.random.default_rng(seed + sensor_id)
+        sign = 1 if sensor_id == 3 else -1
+        df = pd.DataFrame({'epoch_seconds': df['epoch_seconds'],
+                           sensor_columns[sensor_id]: sign*rng.normal(250, 20, n_samples)})
+    return(df.to_csv(index=False, float_format='%.4f').encode())
+
+def make_response(df):
+    """Builds a requests response holding a dataframe as an FMC CSV body
+    :param df: dataframe to serialize, as returned by make_amphr_df
+    :return response: response that can be passed to Deployment.load_to_df
+    """
+    response = requests.models.Response()
+    response.status_code = 200
+    response.encoding = 'utf-8'
+    response._content = df.drop(columns='datetime').to_csv(index=False, float_format='%.4f').encode()
+    return(response)
+
+class StubFMCServer(ThreadingMixIn, HTTPServer):
+    """Local stand-in for the FMC sensor API that serves synthetic sensor data.
+    The number of samples returned is taken from the deployment ID."""
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.bodies = {}
+
+class StubFMCHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        did = int(re.search(r'did=(\d+)', self.path).group(1))
+        sensor_id = int(re.search(r'sensor_id=(\d+)', self.path).group(1))
+        if (did, sensor_id) not in self.server.bodies:
+            self.server.bodies[(did, sensor_id)] = make_sensor_csv(sensor_id, did)
+        body = self.server.bodies[(did, sensor_id)]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_fmc():
+    """Starts the stand-in FMC API on a free local port
+    :return server: the running server
+    :return api_url: URL to use in place of fmc_api_url
+    """
+    server = StubFMCServer(('127.0.0.1', 0), StubFMCHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return(server, "http://127.0.0.1:"+str(server.server_address[1])+"/slapi/sensors/")
+
+def legacy_load_to_df(api_response):
+    """The original text splitting CSV loader, kept as a reference for load_to_df"""
+    response_list = api_response.text.split('\n')
+    response_list = [i.split(',') for i in response_list]
+    df = pd.DataFrame(response_list)
+    df = df.rename(columns=df.iloc[0])
+    df = df.tail(df.shape[0] -1)
+    df = df.reset_index(drop=True)
+    df = df.dropna()
+    df['datetime'] = pd.to_datetime(df['epoch_seconds'], unit='s')
+    return(df)
+
+def legacy_rolling_avg(df, sensor_name, interval):
+    """The original row by row rolling average, kept as a reference for the vectorized engine"""
+    dates = []
+    averages = []
+    for i in df.index:
+        if (df['epoch_seconds'][i] - df['epoch_seconds'][0]) <  interval:
+            continue
+        else:
+            look_back = i
+            while ((df['epoch_seconds'][i] - df['epoch_seconds'][look_back]) < interval):
+                look_back-=1
+            time_delta = (df['epoch_seconds'][i] - df['epoch_seconds'][look_back]) / 86400
+            data_delta = df[sensor_name][i] - df[sensor_name][look_back]
+            data_rate = data_delta / time_delta
+            if data_rate < 0:
+                data_rate = math.nan
+            if data_rate > 3*(np.nanmean(averages)):
+                data_rate = math.nan
+            dates.append(df['datetime'][i])
+            averages.append(data_rate)
+    return(dates, averages)
+
+def check_rolling_avg(n_samples, interval=259200):
+    """Checks the vectorized rolling average against the original implementation"""
+    df = make_amphr_df(n_samples, days=60)
+    deployment = Deployment("cp_000", "1", 0)
+    legacy_dates, legacy_rates = legacy_rolling_avg(df, sensor_name, interval)
+    dates, rates = deployment.calculate_rolling_avg(df, sensor_name, interval)
+    assert dates == legacy_dates, "rolling average dates differ from the original implementation"
+    np.testing.assert_array_equal(np.array(rates), np.array(legacy_rates, dtype=float))
+    print("calculate_rolling_avg matches the original implementation on {:,} samples".format(n_samples))
+
+def check_load_to_df(n_samples):
+    """Checks that load_to_df gives the same converted dataframe as the original loader"""
+    response = make_response(make_amphr_df(n_samples))
+    deployment = Deployment("cp_000", "1", 0)
+    legacy_df = deployment.convert_df_data_types(legacy_load_to_df(response), 'float')
+    df = deployment.convert_df_data_types(deployment.load_to_df(response), 'float')
+    # datetime is derived from epoch_seconds, from its text by the original loader, so it can
+    # differ in the last nanoseconds
+    pd.testing.assert_frame_equal(df.drop(columns='datetime'), legacy_df.drop(columns='datetime'))
+    print("load_to_df matches the original loader on {:,} rows".format(n_samples))
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB"""
+    try:
+        # Linux keeps a peak that can be reset, see reset_peak_rss
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return(int(line.split()[1]) / 1e3)
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return(peak / 1e6 if sys.platform == 'darwin' else peak / 1e3)
+
+def reset_peak_rss():
+    """Resets the peak RSS reported by peak_rss_mb to the current RSS where the OS allows it (Linux),
+    so that the memory used to build a benchmark's inputs doesn't hide the peak of the timed call"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+    except OSError:
+        pass
+
+def timed_call(func, *args):
+    """Makes a function call
+    :return seconds: wall time of the call
+    :return rss_increase_mb: how much the peak RSS of the process grew during the call, in MB
+    """
+    reset_peak_rss()
+    peak_before = peak_rss_mb()
+    start = time.perf_counter()
+    func(*args)
+    seconds = time.perf_counter() - start
+    return(seconds, peak_rss_mb() - peak_before)
+
+# Benchmarks. Each one prepares its inputs, then returns timed_call of the part being
+# measured. The stand-in API serves n_samples rows for deployment ID n_samples.
+
+def bench_load_to_df(n_samples, api_url):
+    """Parses an FMC response and converts its data types, as the pipeline does"""
+    response = make_response(make_amphr_df(n_samples))
+    deployment = Deployment("cp_000", "1", n_samples)
+    return(timed_call(lambda r: deployment.convert_df_data_types(deployment.load_to_df(r), 'float'), response))
+
+def bench_legacy_load_to_df(n_samples, api_url):
+    """bench_load_to_df with the original loader"""
+    response = make_response(make_amphr_df(n_samples))
+    deployment = Deployment("cp_000", "1", n_samples)
+    return(timed_call(lambda r: deployment.convert_df_data_types(legacy_load_to_df(r), 'float'), response))
+
+def bench_convert_df_data_types(n_samples, api_url):
+    deployment = Deployment("cp_000", "1", n_samples)
+    df = deployment.load_to_df(make_response(make_amphr_df(n_samples)))
+    return(timed_call(deployment.convert_df_data_types, df, 'float'))
+
+def bench_calculate_rolling_avg(n_samples, api_url):
+    deployment = Deployment("cp_000", "1", n_samples)
+    df = deployment.convert_df_data_types(deployment.load_to_df(make_response(make_amphr_df(n_samples))), 'float')
+    return(timed_call(deployment.calculate_rolling_avg, df, sensor_name, 259200))
+
+def bench_rolling_rates(n_samples, api_url):
+    deployment = Deployment("cp_000", "1", n_samples)
+    df = deployment.convert_df_data_types(deployment.load_to_df(make_response(make_amphr_df(n_samples))), 'float')
+    return(timed_call(process_battery_stats.rolling_rates, df['epoch_seconds'].values, df[sensor_name].values,
+                      process_battery_stats.rolling_intervals))
+
+def bench_get_bpump_averages(n_samples, api_url):
+    deployment = Deployment("cp_000", "1", n_samples, api_url=api_url, cache_dir=None)
+    return(timed_call(deployment.get_bpump_averages, n_samples))
+
+def bench_deployment(n_samples, api_url):
+    """Runs main() over a single deployment, from fetching its data to writing its plot"""
+    with tempfile.TemporaryDirectory() as tmp:
+        row = pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "all_deployments.csv")).head(1)
+        row['deployment_id'] = n_samples
+        row.to_csv(os.path.join(tmp, "deployments.csv"), index=False)
+        process_battery_stats.all_deployments = os.path.join(tmp, "deployments.csv")
+        return(timed_call(process_battery_stats.main, ['--api-url', api_url, '--no-cache', '--output-dir', tmp]))
+
+benchmarks = {
+    'load_to_df': bench_load_to_df,
+    'legacy_load_to_df': bench_legacy_load_to_df,
+    'convert_df_data_types': bench_convert_df_data_types,
+    'calculate_rolling_avg': bench_calculate_rolling_avg,
+    'rolling_rates': bench_rolling_rates,
+    'get_bpump_averages': bench_get_bpump_averages,
+    'deployment': bench_deployment,
+}
+
+def run_benchmark(name, n_samples, api_url, repeat, queue):
+    """Runs a benchmark several times and reports the best wall time and the largest peak RSS increase"""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        runs = [benchmarks[name](n_samples, api_url) for _ in range(repeat)]
+    queue.put((min(seconds for seconds, _ in runs), max(increase for _, increase in runs)))
+
+def measure(name, n_samples, api_url, repeat):
+    """Runs a benchmark in a fresh process so that its peak RSS is not affected by the others
+    :return result: dictionary with the benchmark name, samples, seconds, rows_per_second and
+        rss_increase_mb
+    """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_benchmark, args=(name, n_samples, api_url, repeat, queue))
+    process.start()
+    seconds, increase = queue.get()
+    process.join()
+    return({'benchmark': name, 'samples': n_samples, 'seconds': seconds,
+            'rows_per_second': n_samples / seconds, 'rss_increase_mb': increase})
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Compares benchmark results with a saved baseline
+    :param results: list of results as returned by measure
+    :param baseline: list of results loaded from a baseline file
+    :param tolerance: fractional increase in wall time or peak RSS increase allowed before a result counts
+        as a regression
+    :return regressions: list of descriptions of the results that regressed
+    """
+    previous = {(result['benchmark'], result['samples']): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result['benchmark'], result['samples']))
+        if before is None:
+            continue
+        for key in ['seconds', 'rss_increase_mb']:
+            # Skip measures the baseline doesn't have, or that were too small to compare
+            if not before.get(key):
+                continue
+            change = result[key] / before[key] - 1
+            if change > tolerance:
+                regressions.append("{} on {:,} samples: {} {:.3f} -> {:.3f} ({:+.0%})".format(
+                    result['benchmark'], result['samples'], key, before[key], result[key], change))
+    return(regressions)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help="numbers of samples in the synthetic sensor series")
+    parser.add_argument('--benchmarks', nargs='+', default=list(benchmarks), choices=list(benchmarks),
+                        help="benchmarks to run")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each benchmark, the best is reported")
+    parser.add_argument('--check-samples', type=int, default=2000,
+                        help="samples used to check results against the original implementation, 0 to skip")
+    parser.add_argument('--baseline', help="baseline results to compare against")
+    parser.add_argument('--save-baseline', help="file to save the results to as a new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="fractional increase allowed before a result counts as a regression")
+    args = parser.parse_args(argv)
+
+    if args.check_samples:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            check_rolling_avg(args.check_samples)
+            check_load_to_df(args.check_samples)
+
+    server, api_url = start_stub_fmc()
+    results = []
+    print("{:<24}{:>12}{:>12}{:>14}{:>24}".format("benchmark", "samples", "seconds", "rows/s",
+                                                "peak RSS increase (MB)"))
+    for n_samples in args.sizes:
+        # Build the stand-in API responses up front so they aren't part of the timings
+        for sensor_id in sensor_columns:
+            server.bodies[(n_samples, sensor_id)] = make_sensor_csv(sensor_id, n_samples)
+        for name in args.benchmarks:
+            result = measure(name, n_samples, api_url, args.repeat)
+            results.append(result)
+            print("{:<24}{:>12,}{:>12.3f}{:>14,.0f}{:>24.1f}".format(name, n_samples, result['seconds'],
+                                                              result['rows_per_second'], result['rss_increase_mb']))
+    server.shutdown()
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as fh:
+            regressions = compare_to_baseline(results, json.load(fh), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: "+regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,424 @@
 #!/usr/bin/env python
 import os
-import math
+import io
+import json
+import hashlib
+import tempfile
 import requests
+import time
 import datetime
 import warnings
+import argparse
 import pandas as pd
 import numpy as np
 from statistics import stdev
-import matplotlib.pyplot as plt
+import matplotlib
+import matplotlib.style
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Specify directory where data products should be stored
 working_directory = '/Users/cdobson/Documents/Github/glider_tools/battery_stats/'
 output_directory = os.path.join(working_directory,"output/")
+# Directory where FMC sensor data is cached between runs
+cache_directory = os.path.join(working_directory,"cache/")
+# Plot style, renamed in matplotlib 3.6
+plot_style = 'seaborn' if 'seaborn' in matplotlib.style.available else 'seaborn-v0_8'
+# Battery capacity registry, kept next to this script
+battery_capacities = os.path.join(os.path.dirname(os.path.abspath(__file__)), "battery_capacities.json")
 
 # Import CSV containing OOI deployment metadata
 # Can be re-produced with link http://ooi-sparel1.whoi.net/fmc-beta/slapi/deployments/?all=1&format=csv
 all_deployments = "/Users/cdobson/Documents/Github/glider_tools/battery_stats/all_deployments.csv"
-all_deployments_df = pd.read_csv(all_deployments)
+
+# FMC sensor API and the sensors pulled for each deployment
+# (9: m_coulomb_amphr_total, 3: c_climb_bpump, 4: c_dive_bpump)
+fmc_api_url = "http://brookside.whoi.net/fmc-beta/slapi/sensors/"
+fmc_sensor_ids = [9, 3, 4]
+fmc_timeout = 120
+# Columns in FMC sensor data that are not numeric
+non_numeric_columns = ["index", "glider", "datetime"]
+
+# Coulomb counter column, and the column derived from it with the counter resets stitched out
+coulomb_column = "m_coulomb_amphr_total(amp-hrs)"
+stitched_coulomb_column = "m_coulomb_amphr_stitched(amp-hrs)"
+# A drop in the coulomb counter is a reset when it lands at or below the floor, or is larger than
+# the jump, which is more than the counter can really change between consecutive readings (amp-hrs).
+# A reading more than the jump above or below both of its neighbours is a bad reading.
+coulomb_reset_floor = 1.0
+coulomb_jump = 10.0
+
+# Intervals in seconds over which the amphr/day rate is reported, and the one that is plotted
+rolling_intervals = [86400, 259200, 604800, 1209600]
+plot_interval = 259200
+
+def make_session(max_per_host=4, retries=3, backoff_factor=0.5):
+    """Creates a keep-alive session for making calls to the FMC API
+    :param max_per_host: maximum number of open connections to each host
+    :param retries: number of times to retry a failed call
+    :param backoff_factor: base delay in seconds for exponential backoff between retries
+    :return session: requests session shared by all API calls
+    """
+    retry = Retry(total=retries, backoff_factor=backoff_factor,
+                  status_forcelist=[429, 500, 502, 503, 504])
+    # pool_block makes threads wait for a free connection rather than opening
+    # more than max_per_host connections to the same host
+    adapter = HTTPAdapter(pool_maxsize=max_per_host, pool_block=True, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return(session)
+
+fmc_session = make_session()
+
+def prefetch_api_calls(api_calls, session=fmc_session, max_workers=8):
+    """Makes a batch of calls to the FMC API concurrently
+    :param api_calls: list of formatted strings to be made as API calls
+    :param session: requests session to make the calls with
+    :param max_workers: maximum number of calls in flight at once
+    :return responses: dictionary mapping each API call to its response, or to
+        the exception raised if the call failed
+    """
+    responses = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(session.get, api_call, timeout=fmc_timeout): api_call
+                   for api_call in set(api_calls)}
+        for future in as_completed(futures):
+            try:
+                responses[futures[future]] = future.result()
+            except Exception as error:
+                responses[futures[future]] = error
+    return(responses)
+
+def stitch_coulomb_counter(values):
+    """Removes the resets from a coulomb counter series, so that it keeps counting up across them
+    :param values: array of coulomb counter readings in time order, NaN where there is no reading
+    :return stitched: array of cumulative amphr spent, continuing from the last reading before each reset,
+        and NaN for the bad readings
+    """
+    values = np.asarray(values, dtype=np.result_type(np.asarray(values).dtype, np.float32))
+    valid = np.flatnonzero(values == values)
+    readings = values[valid]
+    # A single reading far above or below both of its neighbours is a bad reading. Stitching
+    # it would shift every reading after it, so it is dropped instead.
+    before = readings[1:-1] - readings[:-2]
+    after = readings[1:-1] - readings[2:]
+    spikes = np.zeros(len(readings), dtype=bool)
+    spikes[1:-1] = ((before > coulomb_jump) & (after > coulomb_jump)) | ((before < -coulomb_jump) & (after < -coulomb_jump))
+    kept = valid[~spikes]
+    steps = np.diff(readings[~spikes])
+    # A drop to near zero or a drop larger than the jump is a reset by the glider or by hand. Carry
+    # the amount lost at each reset forward onto every reading after it. Smaller drops are jitter
+    # in the counter and are left alone.
+    resets = (steps < 0) & ((values[kept[1:]] <= coulomb_reset_floor) | (steps < -coulomb_jump))
+    offsets = np.zeros(len(values), dtype=values.dtype)
+    offsets[kept[1:][resets]] = -steps[resets]
+    stitched = values + np.cumsum(offsets, dtype=values.dtype)
+    stitched[valid[spikes]] = np.nan
+    return(stitched)
+
+class CoulombStitcher:
+    """Removes the resets from a coulomb counter series one reading at a time, with the same rules
+    as stitch_coulomb_counter. A reading can only be told apart from a bad reading once the reading
+    after it has arrived, so each reading is stitched by the update after it, or by flush."""
+    def __init__(self):
+        """
+        :return: null
+        """
+        # The reading waiting on the next one, as (epoch_seconds, value), and the reading before it
+        self.pending = None
+        self.previous = None
+        # The last reading that was not a bad reading, and the amount lost to resets so far
+        self.last_kept = None
+        self.offset = 0.0
+
+    def update(self, epoch_seconds, value):
+        """Adds a reading to the series
+        :param epoch_seconds: reading time in epoch seconds, later than any reading added before
+        :param value: coulomb counter reading, NaN if there is none
+        :return stitched: list of (epoch_seconds, stitched value) for the reading this one completes,
+            with NaN for a bad reading, or an empty list
+        """
+        if value != value:
+            return([])
+        stitched = [] if self.pending is None else [self._stitch(value)]
+        self.pending = (epoch_seconds, value)
+        return(stitched)
+
+    def flush(self):
+        """Stitches the reading waiting on the next one, e.g. at the end of a series
+        :return stitched: list of (epoch_seconds, stitched value) for that reading, or an empty list
+        """
+        stitched = [] if self.pending is None else [self._stitch(None)]
+        self.pending = None
+        return(stitched)
+
+    def _stitch(self, following):
+        epoch_seconds, value = self.pending
+        previous, self.previous = self.previous, value
+        if previous is not None and following is not None:
+            before, after = value - previous, value - following
+            if (before > coulomb_jump and after > coulomb_jump) or (before < -coulomb_jump and after < -coulomb_jump):
+                return((epoch_seconds, np.nan))
+        if self.last_kept is not None:
+            step = value - self.last_kept
+            if step < 0 and (value <= coulomb_reset_floor or step < -coulomb_jump):
+                self.offset -= step
+        self.last_kept = value
+        return((epoch_seconds, value + self.offset))
+
+def _look_back(epoch_seconds, intervals):
+    """Finds the last sample at least an interval before each sample, for several intervals at once
+    :param epoch_seconds: array of sample times in epoch seconds, sorted ascending
+    :param intervals: array of intervals in seconds
+    :return look_back: (intervals x samples) array of look back positions, -1 where a sample has
+        less than a full interval of data behind it
+    :return elapsed: (intervals x samples) array of the seconds from the look back to each sample,
+        where there is one
+    """
+    # Search a few units in the last place past each target, so rounding in (epoch_seconds - interval)
+    # can only leave the look back too late, and only by the samples that close to the target. Those
+    # are stepped back until the time delta test used to define the interval passes. The targets of
+    # every interval are searched together.
+    targets = epoch_seconds - intervals[:, np.newaxis]
+    targets += 2*np.spacing(np.abs(epoch_seconds[[0, -1]]).max() + intervals.max())
+    look_back = np.searchsorted(epoch_seconds, targets.ravel(), side='right').reshape(targets.shape) - 1
+    elapsed = epoch_seconds - epoch_seconds[np.maximum(look_back, 0)]
+    rows, late = np.nonzero((elapsed < intervals[:, np.newaxis]) & (look_back >= 0))
+    while len(late):
+        look_back[rows, late] -= 1
+        elapsed[rows, late] = epoch_seconds[late] - epoch_seconds[np.maximum(look_back[rows, late], 0)]
+        still_late = (elapsed[rows, late] < intervals[rows]) & (look_back[rows, late] >= 0)
+        rows, late = rows[still_late], late[still_late]
+    return(look_back, elapsed)
+
+def _drop_outliers(rates, block_size=4096):
+    """Drops rates more than 3x the mean of the rates kept before them, in place
+    :param rates: array of rates in series order, NaN where there is no rate
+    :param block_size: number of rates to test per vectorized step
+    :return: null
+    """
+    # Each decision depends on the ones before it, but outliers are rare: test a block
+    # of rates against the running mean as if all were kept, and only step through
+    # the blocks that turn out to hold an outlier one rate at a time
+    running_sum = 0.0
+    running_count = 0
+    for start in range(0, len(rates), block_size):
+        block = rates[start:start+block_size]
+        valid = block == block
+        kept = np.where(valid, block, 0.0)
+        # Summing onto the running sum in series order keeps the rounding of a sequential sum
+        sums = np.cumsum(np.concatenate(([running_sum], kept)))
+        counts = running_count + np.cumsum(valid) - valid
+        outliers = valid & (counts > 0) & (block > 3*(sums[:-1] / np.maximum(counts, 1)))
+        if not outliers.any():
+            running_sum = float(sums[-1])
+            running_count += int(valid.sum())
+            continue
+        for i, rate in enumerate(block.tolist()):
+            if running_count and rate > 3*(running_sum / running_count):
+                block[i] = np.nan
+            elif rate == rate:
+                running_sum += rate
+                running_count += 1
+
+def rolling_rates(epoch_seconds, values, intervals):
+    """Calculates the rate of change per day of a series over several trailing time intervals.
+    The look backs of every interval are found with a single sorted search, and the rates with
+    one subtraction and division over all the intervals.
+    :param epoch_seconds: array of sample times in epoch seconds, sorted ascending
+    :param values: array of sensor values sampled at epoch_seconds
+    :param intervals: list of intervals in seconds over which the rate should be calculated
+    :return starts: for each interval, the position of the first sample with a full interval
+        of data behind it
+    :return rates: (samples x intervals) array of the rate per day calculated for each sample,
+        NaN before the start of each interval or where the rate was rejected
+    """
+    epoch_seconds = np.asarray(epoch_seconds)
+    values = np.asarray(values)
+    intervals = np.asarray(intervals)
+    n = len(epoch_seconds)
+    if n == 0 or len(intervals) == 0:
+        return(np.zeros(len(intervals), dtype=int), np.full((n, len(intervals)), np.nan))
+
+    look_back, elapsed = _look_back(epoch_seconds, intervals)
+    # Since the samples are sorted, the samples with a look back are every sample from
+    # some position onward
+    starts = (look_back < 0).sum(axis=1)
+
+    # Calculate the data deltas over each interval, and divide them in place by the time deltas
+    # in days, which are all (intervals x samples) arrays
+    rates = values - values[np.maximum(look_back, 0)]
+    elapsed /= 86400
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rates /= elapsed
+    rates[look_back < 0] = np.nan
+
+    # Account for cases where the amphr/day rate may have been negative
+    # due to glider resets, manual reset of coloumb counter, etc
+    rates[rates < 0] = np.nan
+
+    for interval_rates, start in zip(rates, starts):
+        _drop_outliers(interval_rates[start:])
+
+    return(starts, rates.T)
+
+def rolling_rate(epoch_seconds, values, interval):
+    """Calculates the rate of change per day of a series over a trailing time interval
+    :param epoch_seconds: array of sample times in epoch seconds, sorted ascending
+    :param values: array of sensor values sampled at epoch_seconds
+    :param interval: interval in seconds over which the rate should be calculated
+    :return indices: positions of the samples for which a rate was calculated
+    :return rates: the rate per day calculated for each of those samples
+    """
+    starts, rates = rolling_rates(epoch_seconds, values, [interval])
+    indices = np.arange(starts[0], len(rates))
+    return(indices, rates[starts[0]:, 0])
+
+_capacity_registries = {}
+
+def load_capacity_registry(path=battery_capacities):
+    """Loads the battery capacity registry, reading each file only once
+    :param path: path to the battery capacity registry json
+    :return registry: dataframe with platform, glider_tail, battery_type and amphr_capacity columns
+    """
+    if path not in _capacity_registries:
+        with open(path, 'r') as fh:
+            registry = pd.DataFrame(json.load(fh)["capacities"])
+        registry['glider_tail'] = registry['glider_tail'].astype(str)
+        _capacity_registries[path] = registry
+    return(_capacity_registries[path])
+
+def resolve_batt_capacities(ref_des, battery_types, registry=None):
+    """Determines the max amphr capacity for many gliders at once from the capacity registry
+    :param ref_des: series of glider reference designators or names (e.g. CP_388)
+    :param battery_types: series of battery types, aligned with ref_des
+    :param registry: capacity registry as returned by load_capacity_registry
+    :return capacities: array of the max amphr capacity for each glider
+    """
+    if registry is None:
+        registry = load_capacity_registry()
+    ref_des = pd.Series(ref_des).reset_index(drop=True).astype(str).str.upper()
+    keys = pd.DataFrame({
+        'platform': ref_des.str[:2],
+        'glider_tail': ref_des.str.extract(r'(\d+)$', expand=False).fillna(""),
+        'battery_type': pd.Series(battery_types).reset_index(drop=True).astype(str),
+        })
+    capacities = pd.Series(np.nan, index=keys.index)
+
+    # Join against the registry once per combination of wildcards, from the most
+    # specific combination to the least, keeping the first capacity found
+    key_names = ['platform', 'battery_type', 'glider_tail']
+    is_wildcard = registry[key_names] == "*"
+    for pattern in sorted(is_wildcard.drop_duplicates().itertuples(index=False), key=lambda p: tuple(p)):
+        matched_keys = [name for name, wildcard in zip(key_names, pattern) if not wildcard]
+        rules = registry[(is_wildcard == list(pattern)).all(axis=1)]
+        if matched_keys:
+            rules = rules.drop_duplicates(matched_keys)
+            merged = keys.merge(rules[matched_keys+['amphr_capacity']], how='left', on=matched_keys)
+            found = merged['amphr_capacity']
+        else:
+            found = pd.Series(rules['amphr_capacity'].iloc[0], index=keys.index)
+        capacities = capacities.fillna(found)
+
+    if capacities.isna().any():
+        raise ValueError("No battery capacity registered for "+", ".join(ref_des[capacities.isna()]))
+    return(capacities.values.astype(int))
+
+def sensor_cache_path(cache_dir, did, sensor_id):
+    """Generates the path of the cache file for a specific sensor and deployment
+    :param cache_dir: directory where cached sensor data is stored
+    :param sensor_id: sensor ID of the cached data
+    :param did: deployment ID of the cached data
+    :return path: path to the cache file
+    """
+    return(os.path.join(cache_dir, "did"+str(did)+"_sensor"+str(sensor_id)+".npz"))
+
+def read_sensor_cache(cache_dir, did, sensor_id):
+    """Loads cached sensor data for a deployment into a dataframe
+    :param cache_dir: directory where cached sensor data is stored
+    :param did: deployment ID of the cached data
+    :param sensor_id: sensor ID of the cached data
+    :return df: dataframe in the same format as convert_df_data_types returns,
+        or None if nothing has been cached
+    """
+    path = sensor_cache_path(cache_dir, did, sensor_id)
+    if not os.path.isfile(path):
+        return(None)
+    with np.load(path) as cache:
+        columns = cache['columns'].tolist()
+        df = pd.DataFrame({name: cache['column'+str(i)] for i, name in enumerate(columns)}, columns=columns)
+    df['datetime'] = pd.to_datetime(df['epoch_seconds'], unit='s')
+    return(df)
+
+def sensor_cache_fetch_time(cache_dir, did, sensor_id):
+    """Finds when the cached sensor data for a deployment was fetched from the FMC
+    :param cache_dir: directory where cached sensor data is stored
+    :param did: deployment ID of the cached data
+    :param sensor_id: sensor ID of the cached data
+    :return fetched_epoch_seconds: time of the fetch in epoch seconds, or None if nothing has
+        been cached or the cache was written before fetch times were stored
+    """
+    path = sensor_cache_path(cache_dir, did, sensor_id)
+    if not os.path.isfile(path):
+        return(None)
+    with np.load(path) as cache:
+        if 'fetched_epoch_seconds' not in cache.files:
+            return(None)
+        return(float(cache['fetched_epoch_seconds']))
+
+def write_sensor_cache(cache_dir, did, sensor_id, df, fetched_epoch_seconds):
+    """Stores sensor data for a deployment in the cache, one array per column
+    :param cache_dir: directory where cached sensor data is stored
+    :param did: deployment ID of the data
+    :param sensor_id: sensor ID of the data
+    :param df: dataframe of converted sensor data to cache
+    :param fetched_epoch_seconds: time the data was fetched from the FMC in epoch seconds
+    :return: null
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    # datetime is derived from epoch_seconds when the cache is read
+    columns = [name for name in df.columns if name != 'datetime']
+    arrays = {}
+    for i, name in enumerate(columns):
+        values = df[name].values
+        arrays['column'+str(i)] = values.astype(str) if values.dtype == object else values
+    # Write to a temporary file of our own first, so an interrupted run can't leave a partial
+    # cache and runs sharing the cache directory can't swap in each other's partial files
+    path = sensor_cache_path(cache_dir, did, sensor_id)
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            np.savez(fh, columns=np.array(columns), fetched_epoch_seconds=np.float64(fetched_epoch_seconds),
+                     **arrays)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
 class Deployment:
     """A class to generate and make API calls to the FMC and process the data they return."""
-    def __init__(self, glider, dnum, did):
+    def __init__(self, glider, dnum, did, api_url=fmc_api_url, session=fmc_session, cache_dir=cache_directory):
         """Creates data products for a specific deployment of a glider
         :param glider: glider name (e.g. cp_340)
         :param dnum: deployment number
         :param did: FMC deployment ID
+        :param api_url: FMC sensor API to make calls to
+        :param session: requests session to make API calls with
+        :param cache_dir: directory to cache sensor data in, or None to disable caching
         :return: null
         """
         self.glider = glider
         self.dnum = dnum
         self.did = did
+        self.api_url = api_url
+        self.session = session
+        self.cache_dir = cache_dir
+        # Responses already fetched by prefetch_api_calls, keyed by API call
+        self.responses = {}
 
     def generate_api_call(self, sensor_id, did):
         """Generates a string to be used as an API call to pull data for a specific sensor and deployment
@@ -37,7 +426,7 @@ class Deployment:
         :param did: deployment ID to pull data for
         :return api_call: formatted string to be made as an API call to the FMC
         """
-        api_call = "http://brookside.whoi.net/fmc-beta/slapi/sensors/?did="+str(did)+"&+sensor_id="+str(sensor_id)+         "&format=csv"
+        api_call = self.api_url+"?did="+str(did)+"&+sensor_id="+str(sensor_id)+         "&format=csv"
         return(api_call)
 
     def make_api_call(self, api_call):
@@ -45,7 +434,12 @@ class Deployment:
         :param api_call: formatted string to be made as an API call
         :return response: response from the API call
         """
-        response = requests.get(api_call)
+        if api_call in self.responses:
+            response = self.responses[api_call]
+            if isinstance(response, Exception):
+                raise response
+        else:
+            response = self.session.get(api_call, timeout=fmc_timeout)
         return(response)
 
     def load_to_df(self, api_response):
@@ -53,15 +447,12 @@ class Deployment:
         :param api_response: response from an API call to the FMC
         :return df: formatted dataframe loaded with data from a FMC API call
         """
-        # format the API call data
-        response_list = api_response.text.split('\n')
-        response_list = [i.split(',') for i in response_list]
-        # load the data into a dataframe and clean it up
-        df = pd.DataFrame(response_list)
-        df = df.rename(columns=df.iloc[0])
-        df = df.tail(df.shape[0] -1)
-        df = df.reset_index(drop=True)
-        df = df.dropna()
+        # Parse the response body straight into typed columns rather than
+        # splitting the decoded text into lists of strings
+        content = api_response.content
+        header = content.split(b'\n', 1)[0].decode().strip().split(',')
+        dtypes = {name: np.float64 for name in header if name not in non_numeric_columns}
+        df = pd.read_csv(io.BytesIO(content), dtype=dtypes, engine='c')
         # add a column that converts timestamps to datetime
         df['datetime'] = pd.to_datetime(df['epoch_seconds'], unit='s')
         return(df)
@@ -72,16 +463,106 @@ class Deployment:
         :param new_type: new type to convert to
         :return df: dataframe with converted datatypes
         """
-        # Columns to not convert the type of
-        exclude_list = ["index", "glider", "datetime"]
-        # Convert the datatypes
-        for (columnName, columnData) in df.iteritems():
-            if columnName in exclude_list:
+        # Convert the datatypes, skipping the columns that are not numeric
+        for (columnName, columnData) in df.items():
+            if columnName in non_numeric_columns:
                 continue
             else:
                 df[columnName] = pd.to_numeric(df[columnName], downcast=new_type)
         return(df)
 
+    def download_sensor_df(self, sensor_id, did):
+        """Loads the data for a specific sensor and deployment from the FMC, without the cache
+        :param sensor_id: sensor ID to pull data for
+        :param did: deployment ID to pull data for
+        :return df: dataframe with converted datatypes
+        """
+        api_call = self.generate_api_call(sensor_id, did)
+        df = self.load_to_df(self.make_api_call(api_call))
+        df = self.convert_df_data_types(df, "float")
+        return(df)
+
+    def is_cached(self, sensor_id, did, end_date_epoch=None):
+        """Checks whether the complete data for a specific sensor and deployment is in the cache,
+        that is the deployment has been recovered and the cache was fetched after its end date
+        :param sensor_id: sensor ID to check
+        :param did: deployment ID to check
+        :param end_date_epoch: end date of the deployment in epoch seconds, or None if it is active
+        :return: bool dependent on whether complete cached data exists
+        """
+        if self.cache_dir is None or end_date_epoch is None:
+            return(False)
+        fetched_epoch_seconds = sensor_cache_fetch_time(self.cache_dir, did, sensor_id)
+        return(fetched_epoch_seconds is not None and fetched_epoch_seconds >= end_date_epoch)
+
+    def get_sensor_df(self, sensor_id, did, end_date_epoch=None):
+        """Loads the data for a specific sensor and deployment, using the cache where possible.
+        Recovered deployments whose data was cached after their end date are served from the
+        cache without calling the FMC. Otherwise the full series is fetched and cached.
+        :param sensor_id: sensor ID to pull data for
+        :param did: deployment ID to pull data for
+        :param end_date_epoch: end date of the deployment in epoch seconds, or None if it is active
+        :return df: dataframe with converted datatypes
+        """
+        if self.is_cached(sensor_id, did, end_date_epoch):
+            df = read_sensor_cache(self.cache_dir, did, sensor_id)
+            # Stitched again rather than read from the cache, so that caches written by older
+            # versions follow the current reset rules
+            if coulomb_column in df.columns:
+                df[stitched_coulomb_column] = stitch_coulomb_counter(df[coulomb_column].values)
+            return(df)
+
+        fetched_epoch_seconds = time.time()
+        df = self.download_sensor_df(sensor_id, did)
+        if coulomb_column in df.columns:
+            df[stitched_coulomb_column] = stitch_coulomb_counter(df[coulomb_column].values)
+        if self.cache_dir is not None:
+            write_sensor_cache(self.cache_dir, did, sensor_id, df, fetched_epoch_seconds)
+        return(df)
+
+    def pending_api_calls(self, sensor_ids, did, end_date_epoch=None):
+        """Lists the API calls still needed to load several sensors of a deployment, skipping calls
+        that were already made and sensors whose complete data is in the cache
+        :param sensor_ids: list of sensor IDs to pull data for
+        :param did: deployment ID to pull data for
+        :param end_date_epoch: end date of the deployment in epoch seconds, or None if it is active
+        :return api_calls: list of API calls to make
+        """
+        api_calls = [self.generate_api_call(sensor_id, did) for sensor_id in sensor_ids
+                     if not self.is_cached(sensor_id, did, end_date_epoch)]
+        return([api_call for api_call in api_calls if api_call not in self.responses])
+
+    def fetch_sensors(self, sensor_ids, did, end_date_epoch=None):
+        """Makes the API calls for several sensors of a deployment at once, skipping calls that
+        were already made and sensors whose complete data is in the cache
+        :param sensor_ids: list of sensor IDs to pull data for
+        :param did: deployment ID to pull data for
+        :param end_date_epoch: end date of the deployment in epoch seconds, or None if it is active
+        :return: null
+        """
+        # The sensors endpoint takes a single sensor per call, so the calls are made in parallel
+        api_calls = self.pending_api_calls(sensor_ids, did, end_date_epoch)
+        if api_calls:
+            self.responses.update(prefetch_api_calls(api_calls, self.session, max_workers=len(api_calls)))
+
+    def get_sensors_df(self, sensor_ids, did, end_date_epoch=None):
+        """Loads the data for several sensors of a deployment into one dataframe keyed on time and sensor
+        :param sensor_ids: list of sensor IDs to pull data for
+        :param did: deployment ID to pull data for
+        :param end_date_epoch: end date of the deployment in epoch seconds, or None if it is active
+        :return df: dataframe with a row for every sample of every sensor, including samples that
+            share a timestamp, sorted by epoch_seconds and sensor_id, and NaN in the columns a
+            sensor doesn't report
+        """
+        self.fetch_sensors(sensor_ids, did, end_date_epoch)
+        # Stacked rather than merged on epoch_seconds, which would pair up every sample of one
+        # sensor with every sample of another at a repeated timestamp
+        sensor_dfs = [self.get_sensor_df(sensor_id, did, end_date_epoch).assign(sensor_id=sensor_id)
+                      for sensor_id in sensor_ids]
+        df = pd.concat(sensor_dfs, ignore_index=True, sort=False)
+        df = df.sort_values(['epoch_seconds', 'sensor_id'], kind='stable').reset_index(drop=True)
+        return(df)
+
     def calculate_rolling_avg(self, df, sensor_name, interval):
         """Calculates rolling averages over a specified interval
         :param df: dataframe where values are stored
@@ -90,63 +571,20 @@ class Deployment:
         :return dates: list containing dates for which rolling averages were calculated
         :return averages: list containing the rolling averages that were calculated
         """
-        # Temporary lists to store data
-        dates = []
-        averages = []
-
-        # Calculate rolling averages on the supplied data over the specified interval
-        for i in df.index:
-            # Continue until the time delta is greater than the specified interval
-            if (df['epoch_seconds'][i] - df['epoch_seconds'][0]) <  interval:
-                continue
-            else:
-                # Find the first index of the supplied data where the time delta is
-                # is greater than the time interval we are averaging over
-                look_back = i
-                while ((df['epoch_seconds'][i] - df['epoch_seconds'][look_back]) < interval):
-                    look_back-=1
-                # When the appopriate index is found, calculate the average of the supplied
-                # data over that time interval by calculating the time and data deltas
-                time_delta = (df['epoch_seconds'][i] - df['epoch_seconds'][look_back]) / 86400
-                data_delta = df[sensor_name][i] - df[sensor_name][look_back]
-                data_rate = data_delta / time_delta
-
-                # Account for cases where the amphr/day rate may have been negative
-                # due to glider resets, manual reset of coloumb counter, etc
-                if data_rate < 0:
-                    data_rate = math.nan
-
-                if data_rate > 3*(np.nanmean(averages)):
-                    data_rate = math.nan
-
-                # Append the date and average to the lists to be returned
-                dates.append(df['datetime'][i])
-                averages.append(data_rate)
+        indices, rates = rolling_rate(df['epoch_seconds'].values, df[sensor_name].values, interval)
+        # Return lists of dates and averages to match the format used for plotting
+        dates = df['datetime'].iloc[indices].tolist()
+        averages = rates.tolist()
 
         return(dates, averages)
 
     def get_batt_capacity(self, ref_des, battery_type):
         """Determines the appropriate number to use for the max amphr capacity for a glider
         :param ref_des: reference designator of a glider
-        :param battery_type: name of column for which averages are to be calculated
+        :param battery_type: battery type of the glider (e.g. 4s)
         :return amphr_capacity: the appropriate number to use as max amphr
         """
-        if "CP" in ref_des:
-            if battery_type == "4s":
-                if (("564" in ref_des) or ("583" in ref_des)):
-                    amphr_capacity = 800
-                else:
-                    amphr_capacity = 550
-            else:
-                if (("564" in ref_des) or ("583" in ref_des)):
-                    amphr_capacity = 1050
-                else:
-                    amphr_capacity = 720
-        else:
-            if battery_type == "3s":
-                amphr_capacity = 1050
-            else:
-                amphr_capacity = 800
+        amphr_capacity = int(resolve_batt_capacities([ref_des], [battery_type])[0])
         return(amphr_capacity)
 
     def calculate_ideal_rate(self, dates, amphr_capacity, deployment_length):
@@ -161,149 +599,371 @@ class Deployment:
         ideal_rates = np.full_like(dates, ideal_rate)
         return(ideal_rates)
 
-    def get_bpump_averages(self, did):
+    def get_bpump_averages(self, did, end_date_epoch=None):
         """Calculates the average ballast used for dives/climbs for a given deployment
         :param did: the deployment ID for the deployment of interest
-        :return climb_average: average bpump climb value for a deployment
-        :return dive_average: average bpump dive value for a deployment
+        :param end_date_epoch: end date of the deployment in epoch seconds, or None if it is active
+        :return climb_average: average bpump climb value for a deployment in cc, NaN if not available
+        :return dive_average: average bpump dive value for a deployment in cc, NaN if not available
         """
-        # Generate and make the API call to obtain the climb ballast data, then find the average
-        climb_api_call = self.generate_api_call(3, did)
-        climb_response = self.make_api_call(climb_api_call)
-        climb_df = self.load_to_df(climb_response)
-        climb_df = self.convert_df_data_types(climb_df, "float")
-
-        if 'c_climb_bpump(X)' in climb_df.columns:
-            climb_average = str(np.nanmean(climb_df['c_climb_bpump(X)']).round(0))+" cc"
-        else:
-            climb_average = "Data not available"
+        # Obtain the climb and dive ballast data together, then find the average of each
+        df = self.get_sensors_df([3, 4], did, end_date_epoch)
 
-        # Generate and make the API call to obtain the dive ballast data, then find the average
-        dive_api_call = self.generate_api_call(4, did)
-        dive_response = self.make_api_call(dive_api_call)
-        dive_df = self.load_to_df(dive_response)
-        dive_df = self.convert_df_data_types(dive_df, "float")
+        if 'c_climb_bpump(X)' in df.columns:
+            climb_average = np.nanmean(df.loc[df['sensor_id'] == 3, 'c_climb_bpump(X)'])
+        else:
+            climb_average = np.nan
 
-        if 'c_dive_bpump(X)' in dive_df.columns:
-            dive_average = str(np.nanmean(dive_df['c_dive_bpump(X)']).round(0))+" cc"
+        if 'c_dive_bpump(X)' in df.columns:
+            dive_average = np.nanmean(df.loc[df['sensor_id'] == 4, 'c_dive_bpump(X)'])
         else:
-            dive_average = "Data not available"
+            dive_average = np.nan
 
         return(climb_average, dive_average)
 
+def select_deployment_rows(all_deployments_df):
+    """Selects the deployments to process from the deployment metadata
+    :param all_deployments_df: dataframe loaded from the deployment metadata csv
+    :return: iterator of the (index, row) pairs of the deployments to process, in file order, up to the
+        first Endurance glider or deployment without an official deployment number
+    """
+    for index, row in all_deployments_df.iterrows():
+        # Weed out Endurance gliders
+        if "ce" in row['glider_glider_name']:
+            break
+
+        # Skip the rows without official deployment numbers
+        if pd.isna(row['dnum']):
+            break
+
+        yield(index, row)
+
+def summarize_deployments(amphr_df, deployments_df, sensor_name):
+    """Calculates battery statistics for many deployments at once
+    :param amphr_df: amphr data for all deployments stacked into one dataframe,
+        with epoch_seconds, sensor_name and deployment_id columns
+    :param deployments_df: dataframe with one row per deployment and deployment_id,
+        max_batt_capacity and expected_deployment_duration columns
+    :param sensor_name: name of the amphr column in amphr_df
+    :return stats_df: dataframe of battery statistics indexed by deployment_id
+    """
+    # Find the extremes of every deployment in a single grouped pass
+    extremes = amphr_df.groupby('deployment_id').agg({sensor_name: ['max', 'min'], 'epoch_seconds': ['max', 'min']})
+    extremes.columns = ['amphr_high', 'amphr_low', 'last_epoch_seconds', 'first_epoch_seconds']
+    stats_df = deployments_df.set_index('deployment_id').join(extremes, how='inner')
+
+    amphr_spent = stats_df['amphr_high'] - stats_df['amphr_low']
+    stats_df['amphr_spent'] = amphr_spent.round(2)
+    stats_df['amphr_available'] = (stats_df['max_batt_capacity'] - stats_df['amphr_low']).round(2)
+    stats_df['max_rate'] = (stats_df['amphr_available'] / stats_df['expected_deployment_duration']).round(2)
+    stats_df['days_deployed'] = ((stats_df['last_epoch_seconds'] - stats_df['first_epoch_seconds']) / 86400).round(2)
+    stats_df['actual_deployment_rate'] = (amphr_spent / stats_df['days_deployed']).round(2)
+    stats_df['amphr_remaining_at_recovery'] = (stats_df['max_batt_capacity'] - stats_df['amphr_high']).round(2)
+    stats_df['days_remaining_at_recovery'] = (stats_df['amphr_remaining_at_recovery'] /
+                                              stats_df['actual_deployment_rate']).round(2)
+    return(stats_df)
+
+def read_stats_table(output_dir):
+    """Reads the fleet battery statistics table written by a previous run
+    :param output_dir: directory where the table was saved
+    :return stats_df: dataframe of battery statistics indexed by deployment_id,
+        or None if no table has been written
+    """
+    path = os.path.join(output_dir, "battery_stats.csv")
+    if not os.path.isfile(path):
+        return(None)
+    return(pd.read_csv(path, index_col='deployment_id', dtype={'dnum': str, 'file_name': str}))
+
+def write_stats_table(stats_df, output_dir):
+    """Writes the fleet battery statistics table as CSV, and as Parquet if a Parquet engine is installed
+    :param stats_df: dataframe of battery statistics as returned by summarize_deployments
+    :param output_dir: directory where the table should be saved
+    :return: null
+    """
+    stats_df.to_csv(os.path.join(output_dir, "battery_stats.csv"))
+    try:
+        stats_df.to_parquet(os.path.join(output_dir, "battery_stats.parquet"))
+    except ImportError:
+        pass
+
+def deployment_hash(row):
+    """Hashes a row of deployment metadata so that changes to it can be detected
+    :param row: row of the deployment metadata csv
+    :return: hex digest of the row contents
+    """
+    return(hashlib.sha1(row.drop(labels='file_name').to_json().encode()).hexdigest())
+
+def read_manifest(output_dir):
+    """Reads the manifest recording the state of each deployment when it was last processed
+    :param output_dir: directory where the manifest is saved
+    :return manifest: dictionary keyed by deployment ID (as a string) of dictionaries with
+        last_epoch_seconds, input_hash and file_name
+    """
+    path = os.path.join(output_dir, "battery_stats_manifest.json")
+    if not os.path.isfile(path):
+        return({})
+    with open(path, 'r') as fh:
+        return(json.load(fh))
+
+def write_manifest(output_dir, manifest):
+    """Writes the manifest recording the state of each deployment when it was last processed
+    :param output_dir: directory where the manifest should be saved
+    :param manifest: dictionary as returned by read_manifest
+    :return: null
+    """
+    path = os.path.join(output_dir, "battery_stats_manifest.json")
+    with open(path+".tmp", 'w') as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+    os.replace(path+".tmp", path)
+
+def format_ballast(ballast_average):
+    """Formats an average ballast volume for display
+    :param ballast_average: average ballast volume in cc, NaN if not available
+    :return: the formatted average
+    """
+    if np.isnan(ballast_average):
+        return("Data not available")
+    return(str(np.round(ballast_average, 0))+" cc")
+
+def render_battery_plot(record, output_dir):
+    """Plots the rolling and ideal amphr/day rates and battery stats for a deployment
+    :param record: dictionary of the rates calculated for a deployment and its row of the
+        battery statistics table
+    :param output_dir: directory where the plot should be saved
+    :return file_title: file name of the saved plot
+    """
+    # Draw on a standalone Agg figure rather than the pyplot state machine so
+    # that plots can be rendered in parallel processes
+    with matplotlib.style.context(plot_style):
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+
+        # Make a line plot of ideal amphr/day rate, rolling 3 day rate and battery stats
+        ax.plot(record['dates'], record['rates'], color='green', linewidth=3,
+                label=record['sensor_name']+ "/day rolling 3 day average")
+        ax.plot(record['dates'], record['ideal_rates'], color='red', linewidth=3,
+                label = "Maximum daily rate (amphr/day)")
+
+        # modify ticks size
+        ax.tick_params(axis='x', labelsize=14, labelrotation=-45)
+        ax.tick_params(axis='y', labelsize=14)
+        ax.legend()
+
+        # title and labels
+        title = record['glider']+" D"+str(record['dnum'].zfill(5))
+        ax.set_title(title+" Battery Stats", fontsize=20)
+        ax.set_xlabel('Time', fontsize=16)
+        ax.set_ylabel('Amphr/day', fontsize=16)
+
+        # place a text box in upper left in axes coords
+        textstr = "\n".join([
+                " ",
+                " ",
+                 record['battery_type']+" Batteries",
+                "Nominal amphr available: "+str(record['max_batt_capacity']),
+                "Actual amphr spent at deployment: "+str(record['amphr_low']),
+                "Actual amphr available for deployment: "+str(record['amphr_available']),
+                "Expected deployment duration: "+str(record['expected_deployment_duration'])+" days",
+                "Max amphr/day allowed for deployment: "+str(record['max_rate']),
+                " ",
+                "Actual days deployed: "+str(record['days_deployed']),
+                "Actual amphr spent at recovery: "+str(record['amphr_high']),
+                "Actual amphr spent for deployment: "+str(record['amphr_spent']),
+                "Actual amphr/day for deployment: "+str(record['actual_deployment_rate']),
+                "Estimated amphr remaining at recovery: "+str(record['amphr_remaining_at_recovery']),
+                "Estimated days remaining at recovery: "+str(record['days_remaining_at_recovery']),
+                "Average climb ballast: "+format_ballast(record['climb_bpump_average']),
+                "Average dive ballast: "+format_ballast(record['dive_bpump_average'])
+                ])
+
+        fig.text(1, 0.35, textstr, fontsize=14, transform=fig.transFigure)
+
+        # save the figure
+        file_title = record['glider']+"-D"+str(record['dnum'].zfill(5))+"_battery_stats.png"
+        fig.savefig(os.path.join(output_dir, file_title), bbox_inches="tight")
+    return(file_title)
+
+def render_battery_plots(records, output_dir, workers=1):
+    """Renders the battery stats plots for many deployments
+    :param records: list of dictionaries of rates and stats as taken by render_battery_plot
+    :param output_dir: directory where the plots should be saved
+    :param workers: number of processes to render with, 1 renders in this process
+    :return file_titles: list with the file name of each saved plot, or the
+        exception raised if a plot could not be rendered
+    """
+    file_titles = []
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(render_battery_plot, record, output_dir) for record in records]
+            for future in futures:
+                error = future.exception()
+                file_titles.append(error if error is not None else future.result())
+    else:
+        for record in records:
+            try:
+                file_titles.append(render_battery_plot(record, output_dir))
+            except Exception as error:
+                file_titles.append(error)
+    return(file_titles)
+
 def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generates battery statistics plots for OOI glider deployments")
+    parser.add_argument('--api-url', default=fmc_api_url, help="FMC sensor API to pull data from")
+    parser.add_argument('--fetch-workers', type=int, default=8, help="number of FMC API calls to make at once")
+    parser.add_argument('--per-host', type=int, default=4, help="maximum open connections to each FMC host")
+    parser.add_argument('--cache-dir', default=cache_directory, help="directory to cache FMC sensor data in")
+    parser.add_argument('--no-cache', action='store_true', help="always pull the full sensor data from the FMC")
+    parser.add_argument('--output-dir', default=output_directory, help="directory to write the plots to")
+    parser.add_argument('--workers', type=int, default=1, help="number of processes to render plots with")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only process deployments that are active or whose metadata changed since the last run")
+    args = parser.parse_args(argv)
+
+    all_deployments_df = pd.read_csv(all_deployments)
     all_deployments_df["file_name"] = " "
+    session = make_session(max_per_host=args.per_host)
+
+    # Load the state of each deployment as of the last run
+    manifest = read_manifest(args.output_dir) if args.incremental else {}
+    input_hashes = {}
+    unchanged = []
+
+    # Select the deployments to process from the deployment metadata csv
+    deployments = []
+    for index, row in select_deployment_rows(all_deployments_df):
+        glider = row['glider_glider_name']
+        deployment = Deployment(glider, str(row['dnum']), row['deployment_id'], api_url=args.api_url,
+                                session=session, cache_dir=None if args.no_cache else args.cache_dir)
+        # Deployments with an end date have been recovered, and their data will not change
+        # once it has been fetched after that date
+        deployment.recovered = not pd.isna(row['end_date_epoch'])
+        deployment.end_date_epoch = float(row['end_date_epoch']) if deployment.recovered else None
+
+        # In incremental mode, recovered deployments whose metadata hasn't changed
+        # since they were last plotted can be left alone
+        input_hashes[deployment.did] = deployment_hash(row)
+        entry = manifest.get(str(deployment.did))
+        if (entry is not None and deployment.recovered and entry['input_hash'] == input_hashes[deployment.did]
+                and os.path.isfile(os.path.join(args.output_dir, entry['file_name']))):
+            unchanged.append(deployment.did)
+            continue
+        deployments.append((index, row, deployment))
+
+    # Fetch the sensor data for every deployment before processing any of them,
+    # since nearly all of the run time is spent waiting on the FMC. Recovered
+    # deployments cached after their end date don't need to be fetched at all.
+    api_calls = [api_call for (index, row, deployment) in deployments
+                 for api_call in deployment.pending_api_calls(fmc_sensor_ids, deployment.did,
+                                                              deployment.end_date_epoch)]
+    responses = prefetch_api_calls(api_calls, session, max_workers=args.fetch_workers)
+
+    sensor_name = coulomb_column
+    amphr_frames = []
+    deployment_rows = []
+    rolling = {}
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", category=RuntimeWarning)
-        # Iterate through the deployment metadata csv and process each row
-        for index, row in all_deployments_df.iterrows():
+        # Process each of the selected deployments
+        for index, row, deployment in deployments:
             try:
-                # Assign the high level deployment metadata
-                did = row['deployment_id']
-                glider = row['glider_glider_name']
-                battery_type = row['batt_type']
-                sensor_name = "m_coulomb_amphr_total(amp-hrs)"
-
-                # Weed out Endurance gliders
-                if "ce" in glider:
-                    break
-
-                # Skip the rows without official deployment numbers
-                if pd.isna(row['dnum']):
-                    break
-                else:
-                    deploy_num = str(row['dnum'])
-
-                # Create an instance of Deployment
-                deployment = Deployment(glider, deploy_num, did)
+                did = deployment.did
+                deployment.responses = responses
 
                 # Expected battery information from deployment metadata
-                deployment.expected_recovery_date = datetime.datetime.fromtimestamp(row['expected_recovery'])
-                deployment.actual_deployment_date = datetime.datetime.fromtimestamp(row['start_date_epoch'])
-                deployment.expected_deployment_duration = (deployment.expected_recovery_date - deployment.actual_deployment_date).days
-
-                # Grab all amphr data from FMC
-                deployment.api_call = deployment.generate_api_call(9, deployment.did)
-                deployment.api_response = deployment.make_api_call(deployment.api_call)
-                deployment.df = deployment.load_to_df(deployment.api_response)
-                deployment.df = deployment.convert_df_data_types(deployment.df, 'float')
-                deployment.amphr_high = np.nanmax(deployment.df[sensor_name])
-                deployment.amphr_low = np.nanmin(deployment.df[sensor_name])
-                deployment.amphr_spent = (deployment.amphr_high - deployment.amphr_low).round(2)
-
-                # Determine max amphr available for this deployment
-                deployment.max_batt_capacity = deployment.get_batt_capacity(glider.upper(), battery_type)
-                deployment.amphr_available = (deployment.max_batt_capacity - deployment.amphr_low).round(2)
-                # Calculate 3 day rolling average of amphr/day
-                deployment.dates, deployment.rates = deployment.calculate_rolling_avg(deployment.df, sensor_name, 259200)
-                deployment.ideal_rates = deployment.calculate_ideal_rate(deployment.dates, deployment.amphr_available,
-                            deployment.expected_deployment_duration)
+                expected_recovery_date = datetime.datetime.fromtimestamp(row['expected_recovery'])
+                actual_deployment_date = datetime.datetime.fromtimestamp(row['start_date_epoch'])
+                expected_deployment_duration = (expected_recovery_date - actual_deployment_date).days
+
+                # Grab all amphr and ballast data from FMC, with the same bulk fetch as the prefetch
+                deployment.fetch_sensors(fmc_sensor_ids, did, deployment.end_date_epoch)
+                df = deployment.get_sensor_df(9, did, deployment.end_date_epoch)
+                # Use the stitched coulomb counter so that every sample counts across resets
+                amphr_df = df[['epoch_seconds', stitched_coulomb_column]].copy()
+                amphr_df['deployment_id'] = did
+
+                # Calculate the rolling averages of amphr/day over every interval at once,
+                # and keep the 3 day one for plotting
+                starts, interval_rates = rolling_rates(df['epoch_seconds'].values, df[stitched_coulomb_column].values,
+                                                       rolling_intervals)
+                plot_column = rolling_intervals.index(plot_interval)
+                dates = df['datetime'].iloc[starts[plot_column]:].tolist()
+                rates = interval_rates[starts[plot_column]:, plot_column].tolist()
 
                 # Calculate the ballast volume averages
-                deployment.climb_average, deployment.dive_average = deployment.get_bpump_averages(did)
-
-                # Calculate various battery-related stats
-                deployment.days_deployed = ((np.nanmax(deployment.df['epoch_seconds']) - np.nanmin(deployment.df['epoch_seconds']))/ 86400).round(2)
-                deployment.amphr_spent_at_recovery = (np.nanmax(deployment.df[sensor_name]) - np.nanmin(deployment.df[sensor_name]))
-                deployment.max_rate = ((deployment.amphr_available) / deployment.expected_deployment_duration).round(2)
-                deployment.actual_deployment_rate = (deployment.amphr_spent_at_recovery / deployment.days_deployed).round(2)
-                deployment.amphr_remaining_at_recovery = (deployment.max_batt_capacity-np.nanmax(deployment.df[sensor_name])).round(2)
-                deployment.days_remaining_at_recovery = (deployment.amphr_remaining_at_recovery / deployment.actual_deployment_rate).round(2)
-
-                # Make a line plot of ideal amphr/day rate, rolling 3 day rate and battery stats
-                plt.style.use('seaborn')
-
-                plt.plot(deployment.dates, deployment.rates, color='green', linewidth=3,
-                         label=sensor_name+ "/day rolling 3 day average")
-                plt.plot(deployment.dates, deployment.ideal_rates, color='red', linewidth=3,
-                         label = "Maximum daily rate (amphr/day)")
-
-                # modify ticks size
-                plt.xticks(fontsize=14, rotation = -45)
-                plt.yticks(fontsize=14)
-                plt.legend()
-
-                # title and labels
-                title = glider+" D"+str(deploy_num.zfill(5))
-                plt.title(title+" Battery Stats", fontsize=20)
-                #plt.ylim([0, 8])
-                plt.xlabel('Time', fontsize=16)
-                plt.ylabel('Amphr/day', fontsize=16)
-
-                # place a text box in upper left in axes coords
-                textstr = "\n".join([
-                        " ",
-                        " ",
-                         battery_type+" Batteries",
-                        "Nominal amphr available: "+str(deployment.max_batt_capacity),
-                        "Actual amphr spent at deployment: "+str(deployment.amphr_low),
-                        "Actual amphr available for deployment: "+str(deployment.amphr_available),
-                        "Expected deployment duration: "+str(deployment.expected_deployment_duration)+" days",
-                        "Max amphr/day allowed for deployment: "+str(deployment.max_rate),
-                        " ",
-                        "Actual days deployed: "+str(deployment.days_deployed),
-                        "Actual amphr spent at recovery: "+str(deployment.amphr_high),
-                        "Actual amphr spent for deployment: "+str(deployment.amphr_spent),
-                        "Actual amphr/day for deployment: "+str(deployment.actual_deployment_rate),
-                        "Estimated amphr remaining at recovery: "+str(deployment.amphr_remaining_at_recovery),
-                        "Estimated days remaining at recovery: "+str(deployment.days_remaining_at_recovery),
-                        "Average climb ballast: "+str(deployment.climb_average),
-                        "Average dive ballast: "+str(deployment.dive_average)
-                        ])
-
-                plt.text(1, 0.35, textstr, fontsize=14, transform=plt.gcf().transFigure)
-
-                # save the figure
-                file_title = glider+"-D"+str(deploy_num.zfill(5))+"_battery_stats.png"
-                plt.savefig(output_directory+file_title, bbox_inches="tight")
-
-                # clear out the figure
-                plt.cla()
-                plt.clf()
-
-                all_deployments_df.at[index, "file_name"] = file_title
+                climb_average, dive_average = deployment.get_bpump_averages(did, deployment.end_date_epoch)
+
+                amphr_frames.append(amphr_df)
+                rolling[did] = (deployment, dates, rates)
+                deployment_rows.append({
+                    'deployment_id': did,
+                    'deployment_name': row['deployment_name'],
+                    'glider': deployment.glider,
+                    'dnum': deployment.dnum,
+                    'battery_type': row['batt_type'],
+                    'recovered': deployment.recovered,
+                    'expected_deployment_duration': expected_deployment_duration,
+                    'climb_bpump_average': climb_average,
+                    'dive_bpump_average': dive_average,
+                    })
+                # Report the latest rate over each interval, to compare short and long term burn rates
+                for interval, column in zip(rolling_intervals, interval_rates.T):
+                    kept = column[column == column]
+                    deployment_rows[-1]["rate_{:g}d".format(interval / 86400)] = \
+                        round(kept[-1], 2) if len(kept) else np.nan
             except:
                 print(str(row['deployment_name'])+" didn't work.")
 
+        if not deployment_rows:
+            return
+
+        # Determine max amphr available for every deployment from the capacity registry
+        deployments_df = pd.DataFrame(deployment_rows)
+        deployments_df['max_batt_capacity'] = resolve_batt_capacities(deployments_df['glider'],
+                                                                      deployments_df['battery_type'])
+
+        # Calculate the battery-related stats for the whole fleet at once
+        stats_df = summarize_deployments(pd.concat(amphr_frames, ignore_index=True), deployments_df,
+                                        stitched_coulomb_column)
+
+        # Collect everything needed to plot each deployment
+        records = []
+        for did in stats_df.index:
+            deployment, dates, rates = rolling[did]
+            record = {column: stats_df.at[did, column] for column in stats_df.columns}
+            record['deployment_id'] = did
+            record['sensor_name'] = sensor_name
+            record['dates'], record['rates'] = dates, rates
+            record['ideal_rates'] = deployment.calculate_ideal_rate(record['dates'], record['amphr_available'],
+                                                                   record['expected_deployment_duration'])
+            records.append(record)
+
+    # Render the plots, spread across worker processes if requested
+    file_titles = render_battery_plots(records, args.output_dir, args.workers)
+    stats_df['file_name'] = ""
+    for record, file_title in zip(records, file_titles):
+        if isinstance(file_title, Exception):
+            print(str(record['deployment_name'])+" didn't work.")
+            manifest.pop(str(record['deployment_id']), None)
+        else:
+            stats_df.at[record['deployment_id'], 'file_name'] = file_title
+            manifest[str(record['deployment_id'])] = {
+                'last_epoch_seconds': float(record['last_epoch_seconds']),
+                'input_hash': input_hashes[record['deployment_id']],
+                'file_name': file_title,
+                }
+
+    # Carry the stats for deployments that were left alone over from the last run
+    previous_stats_df = read_stats_table(args.output_dir) if unchanged else None
+    if previous_stats_df is not None:
+        carried_over = previous_stats_df.index.intersection(unchanged)
+        previous_stats_df = previous_stats_df.loc[carried_over].reindex(columns=stats_df.columns)
+        stats_df = pd.concat([stats_df, previous_stats_df.astype(stats_df.dtypes.to_dict())])
+        stats_df = stats_df.loc[[did for did in all_deployments_df['deployment_id'] if did in stats_df.index]]
+
+    all_deployments_df['file_name'] = all_deployments_df['deployment_id'].map(stats_df['file_name']).fillna(" ")
+    write_stats_table(stats_df, args.output_dir)
+    write_manifest(args.output_dir, manifest)
+
 if __name__ == '__main__':
     main()
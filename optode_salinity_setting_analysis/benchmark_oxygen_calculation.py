@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""benchmark_oxygen_calculation
+Benchmarks the batch oxygen calculation in oxygen_calculation against the
+step by step functions (SVU or calc_o2 followed by do2_salinity_correction)
+on synthetic glider optode and CTD data.
+
+Each benchmark runs in its own process so that its peak RSS can be reported
+alongside its wall time.
+
+Usage
+-----
+python benchmark_oxygen_calculation.py [--sizes N [N ...]] [--repeat N]
+"""
+import sys
+import time
+import argparse
+import resource
+import multiprocessing
+
+import numpy as np
+
+import oxygen_calculation as oc
+
+# SVUFoilCoef and ConcCoef of the DOSTA DPS example
+SVU_FOIL_COEF = np.array([0.002848, 0.000114, 1.51e-6, 70.42301, -0.10302,
+                          -12.9462, 1.265377])
+CONC_COEF = np.array([-0.5, 1.02])
+# FoilPolyDegT and FoilPolyDegO of a 4831 optode
+FOIL_POLY_DEG_T = np.array([1, 0, 0, 0, 1, 2, 0, 1, 2, 3, 0, 1, 2, 3, 4, 0,
+                            1, 2, 3, 4, 5, 0, 0, 0, 0, 0, 0, 0])
+FOIL_POLY_DEG_O = np.array([4, 5, 4, 3, 3, 3, 2, 2, 2, 2, 1, 1, 1, 1, 1, 0,
+                            0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])
+LAT, LON = 40.1, -70.8
+
+
+def make_inputs(n_samples, seed=0):
+    """Builds synthetic calphase, optode temperature and CTD T/S/P arrays
+    shaped like a glider deployment, and MkII foil coefficients that give a
+    positive partial pressure."""
+    rng = np.random.default_rng(seed)
+    inputs = {
+        'calphase': rng.uniform(25., 40., n_samples),
+        'temp': rng.uniform(4., 24., n_samples),
+        'SP': rng.uniform(32., 36., n_samples),
+        'P': rng.uniform(0., 1000., n_samples),
+        }
+    inputs['T'] = inputs['temp'] + rng.normal(0., 0.2, n_samples)
+    foil_coef = rng.uniform(0., 1e-6, len(FOIL_POLY_DEG_T))
+    foil_coef[FOIL_POLY_DEG_T + FOIL_POLY_DEG_O == 0] = 50.
+    return inputs, foil_coef
+
+
+def reference_svu(inputs, foil_coef):
+    DO = oc.SVU(inputs['calphase'], inputs['temp'], SVU_FOIL_COEF, CONC_COEF)
+    return DO, oc.do2_salinity_correction(
+            DO, inputs['P'], inputs['T'], inputs['SP'], LAT, LON)
+
+
+def reference_mkii(inputs, foil_coef):
+    DO, _ = oc.calc_o2(inputs['calphase'], inputs['temp'], foil_coef,
+                       FOIL_POLY_DEG_T, FOIL_POLY_DEG_O, cc=CONC_COEF)
+    return DO, oc.do2_salinity_correction(
+            DO, inputs['P'], inputs['T'], inputs['SP'], LAT, LON)
+
+
+def batch_svu(inputs, foil_coef, engine='numpy'):
+    return oc.calc_o2_batch(
+            inputs['calphase'], inputs['temp'], inputs['T'], inputs['SP'],
+            inputs['P'], LAT, LON, csv=SVU_FOIL_COEF, conc_coef=CONC_COEF,
+            engine=engine)
+
+
+def batch_svu_numexpr(inputs, foil_coef):
+    return batch_svu(inputs, foil_coef, engine='numexpr')
+
+
+def batch_mkii(inputs, foil_coef):
+    return oc.calc_o2_batch(
+            inputs['calphase'], inputs['temp'], inputs['T'], inputs['SP'],
+            inputs['P'], LAT, LON, C=foil_coef, M=FOIL_POLY_DEG_T,
+            N=FOIL_POLY_DEG_O, conc_coef=CONC_COEF, engine='numpy')
+
+
+def reference_svu_l1(inputs, foil_coef):
+    return (oc.SVU(inputs['calphase'], inputs['temp'], SVU_FOIL_COEF,
+                   CONC_COEF, SP=35),)
+
+
+def svu_kernel_numba(inputs, foil_coef, engine='numba'):
+    return (oc.svu_kernel(inputs['calphase'], inputs['temp'], SVU_FOIL_COEF,
+                          CONC_COEF, SP=35, engine=engine),)
+
+
+def svu_kernel_numpy(inputs, foil_coef):
+    return svu_kernel_numba(inputs, foil_coef, engine='numpy')
+
+
+benchmarks = {
+    'reference_svu': reference_svu,
+    'batch_svu': batch_svu,
+    'batch_svu_numexpr': batch_svu_numexpr,
+    'reference_mkii': reference_mkii,
+    'batch_mkii': batch_mkii,
+    'reference_svu_l1': reference_svu_l1,
+    'svu_kernel_numba': svu_kernel_numba,
+    'svu_kernel_numpy': svu_kernel_numpy,
+    }
+# the reference each batch calculation has to match
+references = {
+    'batch_svu': reference_svu,
+    'batch_svu_numexpr': reference_svu,
+    'batch_mkii': reference_mkii,
+    'svu_kernel_numba': reference_svu_l1,
+    'svu_kernel_numpy': reference_svu_l1,
+    }
+
+
+def available(name):
+    """Whether the optional module a benchmark needs is installed."""
+    if name.endswith('numexpr'):
+        return oc.ne is not None
+    if name.endswith('numba'):
+        return oc.numba is not None
+    return True
+
+
+def check_batch(n_samples, rtol=1e-10):
+    """Checks each batch calculation against its reference to `rtol`."""
+    inputs, foil_coef = make_inputs(n_samples)
+    for name, reference in references.items():
+        if not available(name):
+            continue
+        for result, expected in zip(benchmarks[name](inputs, foil_coef),
+                                    reference(inputs, foil_coef)):
+            np.testing.assert_allclose(result, expected, rtol=rtol, atol=0)
+        print("%s matches %s to %g on %d samples"
+              % (name, reference.__name__, rtol, n_samples))
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+def run_benchmark(name, n_samples, repeat, queue):
+    """Runs a benchmark `repeat` times and reports the best wall time and the
+    peak RSS, including the inputs."""
+    inputs, foil_coef = make_inputs(n_samples)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        benchmarks[name](inputs, foil_coef)
+        best = min(best, time.perf_counter() - start)
+    queue.put((best, peak_rss_mb()))
+
+
+def measure(name, n_samples, repeat):
+    """Runs a benchmark in a fresh process so that its peak RSS is not
+    affected by the others."""
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_benchmark,
+                              args=(name, n_samples, repeat, queue))
+    process.start()
+    seconds, peak = queue.get()
+    process.join()
+    return seconds, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Benchmarks the batch oxygen calculation")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000000],
+                        help="numbers of samples to calculate oxygen for")
+    parser.add_argument('--benchmarks', nargs='+', default=list(benchmarks),
+                        choices=list(benchmarks), help="benchmarks to run")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs of each benchmark, the best is reported")
+    parser.add_argument('--check-samples', type=int, default=100000,
+                        help="samples used to check the batch calculation "
+                             "against the reference, 0 to skip")
+    args = parser.parse_args(argv)
+
+    if args.check_samples:
+        check_batch(args.check_samples)
+
+    print("%-20s%12s%12s%16s" % ("benchmark", "samples", "seconds",
+                                 "peak RSS (MB)"))
+    for n_samples in args.sizes:
+        for name in args.benchmarks:
+            if not available(name):
+                continue
+            seconds, peak = measure(name, n_samples, args.repeat)
+            print("%-20s%12d%12.3f%16.1f" % (name, n_samples, seconds, peak))
+
+
+if __name__ == '__main__':
+    main()
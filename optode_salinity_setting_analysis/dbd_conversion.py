@@ -0,0 +1,219 @@
+"""dbd_conversion
+Converts glider science files (EBD/TBD) to netCDF with dbd2netCDF, one output
+file per input file, several files at a time.
+
+Each input file is converted to its own netCDF file in the output directory,
+skipping files whose netCDF output is newer than the input, so adding files to
+a live deployment only converts the new ones. All of the conversions share one
+persistent dbd2netCDF sensor list cache directory. Files with a factored sensor
+list only carry the CRC of their list and need the cache file written by a file
+that carries the full list, so for every sensor list not cached yet one file
+with the full list is converted on its own first, and the rest are converted in
+parallel once the cache is populated. The per-file outputs are merged lazily:
+stream_optode_data reads them one file and chunk at a time, and load_merged
+concatenates the variables it is asked for.
+
+Usage
+-----
+python dbd_conversion.py input/*.EBD --output-dir output/nc --cache-dir cache
+"""
+import os
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from stream_optode_data import read_files
+
+
+def netcdf_path(input_file, output_dir):
+    """Path of the netCDF file an input file is converted to."""
+    return os.path.join(output_dir, os.path.basename(input_file) + '.nc')
+
+
+def is_current(input_file, output_file):
+    """Whether the netCDF output of an input file exists and is newer than
+    the input."""
+    return (os.path.exists(output_file)
+            and os.path.getmtime(output_file) >= os.path.getmtime(input_file))
+
+
+def sensor_list_tags(input_file):
+    """
+    The sensor list CRC of a glider file, lower case, and whether its sensor
+    list is factored out to the cache, from the ASCII header tags.
+
+    Returns
+    -------
+    A tuple of the CRC and a Bool, or (None, None) if the header can't be
+    read, e.g. for compressed files.
+    """
+    tags = {}
+    try:
+        with open(input_file, 'rb') as fid:
+            while len(tags) < int(tags.get('num_ascii_tags', 64)):
+                key, sep, value = fid.readline(256).decode('ascii').partition(
+                        ':')
+                if not sep:
+                    break
+                tags[key.strip()] = value.strip()
+    except (OSError, UnicodeDecodeError, ValueError):
+        return None, None
+    if 'sensor_list_crc' not in tags:
+        return None, None
+    return (tags['sensor_list_crc'].lower(),
+            tags.get('sensor_list_factored', '0') != '0')
+
+
+def _seed_conversions(pending, cache_dir):
+    """
+    Splits pending (input, output) conversions into the ones to run one at a
+    time, in order, to populate the sensor list cache, and the ones that can
+    then run in parallel.
+
+    The first file with the full sensor list of each CRC not cached yet is
+    converted on its own. Files whose header can't be read are all converted
+    on their own, since they may need a cache written by an earlier file.
+    """
+    # dbd2netCDF keeps each sensor list in <crc>.cac
+    cached = set(os.path.splitext(name)[0].lower()
+                 for name in os.listdir(cache_dir)
+                 if name.lower().endswith('.cac'))
+    serial, parallel = [], []
+    for conversion in pending:
+        crc, factored = sensor_list_tags(conversion[0])
+        if crc is None:
+            serial.append(conversion)
+        elif not factored and crc not in cached:
+            cached.add(crc)
+            serial.append(conversion)
+        else:
+            parallel.append(conversion)
+    return serial, parallel
+
+
+def convert_file(input_file, output_file, cache_dir, executable='dbd2netCDF'):
+    """
+    Converts one glider file to netCDF with dbd2netCDF.
+
+    The output is written to a temporary file that is renamed once the
+    conversion has finished, so an interrupted conversion never leaves an
+    output that looks up to date.
+
+    Parameters
+    ----------
+    input_file : str
+        EBD/TBD (or other dbd family) file
+    output_file : str
+        netCDF file to write
+    cache_dir : str
+        dbd2netCDF sensor list cache directory
+    executable : str, optional
+        dbd2netCDF program. Default is 'dbd2netCDF'
+
+    Returns
+    -------
+    output_file
+    """
+    partial = output_file + '.part'
+    try:
+        subprocess.run([executable, '-C', cache_dir, '-o', partial,
+                        input_file],
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                       check=True)
+        os.replace(partial, output_file)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return output_file
+
+
+def convert_files(input_files, output_dir, cache_dir, workers=None,
+                  executable='dbd2netCDF', force=False):
+    """
+    Converts glider files to one netCDF file each, running several dbd2netCDF
+    processes at once once the sensor list cache has every sensor list the
+    files need.
+
+    Parameters
+    ----------
+    input_files : list of str
+        EBD/TBD files
+    output_dir : str
+        Directory to write the netCDF files to, created if needed
+    cache_dir : str
+        dbd2netCDF sensor list cache directory, created if needed and kept
+        between runs
+    workers : int, optional
+        Number of dbd2netCDF processes to run at once. Default is the number
+        of CPUs
+    executable : str, optional
+        dbd2netCDF program. Default is 'dbd2netCDF'
+    force : Bool, optional
+        Convert every file, even if its output is up to date. Default is
+        False
+
+    Returns
+    -------
+    A tuple of the netCDF files, in the order of `input_files`, and the number
+    of files that were converted.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    output_files = [netcdf_path(f, output_dir) for f in input_files]
+    pending = [(i, o) for i, o in zip(input_files, output_files)
+               if force or not is_current(i, o)]
+    # convert a file with each sensor list that isn't cached yet on its own,
+    # so that no conversion reads a cache file another one is still writing
+    serial, parallel = _seed_conversions(pending, cache_dir)
+    for input_file, output_file in serial:
+        convert_file(input_file, output_file, cache_dir, executable)
+    if parallel:
+        # each worker thread only waits on its dbd2netCDF process, so threads
+        # are enough to keep `workers` conversions running
+        with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            # list() to raise the first failed conversion, if any
+            list(pool.map(lambda io: convert_file(*io, cache_dir=cache_dir,
+                                                  executable=executable),
+                          parallel))
+    return output_files, len(pending)
+
+
+def load_merged(netcdf_files, variables):
+    """Concatenates `variables` (names mapped to netCDF variable names) over
+    the per-file netCDF outputs into a dictionary of float arrays, with NaN
+    for variables a file doesn't have."""
+    chunks = list(read_files(netcdf_files, variables, chunk_size=100000))
+    return dict((name, np.concatenate([c[name] for c in chunks])
+                 if chunks else np.array([])) for name in variables)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Converts glider files to one netCDF file each with "
+                        "dbd2netCDF, skipping files already converted")
+    parser.add_argument('inputs', nargs='+', help="EBD/TBD files")
+    parser.add_argument('--output-dir', required=True,
+                        help="directory to write the netCDF files to")
+    parser.add_argument('--cache-dir', required=True,
+                        help="dbd2netCDF sensor list cache directory")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of conversions to run at once")
+    parser.add_argument('--dbd2netcdf', default='dbd2netCDF',
+                        help="dbd2netCDF program")
+    parser.add_argument('--force', action='store_true',
+                        help="convert files even if their output is up to "
+                             "date")
+    args = parser.parse_args(argv)
+
+    output_files, converted = convert_files(
+            sorted(args.inputs), args.output_dir, args.cache_dir,
+            workers=args.workers, executable=args.dbd2netcdf,
+            force=args.force)
+    print("Converted {:d} of {:d} files to {:s}".format(
+            converted, len(output_files), args.output_dir))
+
+
+if __name__ == '__main__':
+    main()
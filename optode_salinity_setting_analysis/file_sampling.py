@@ -0,0 +1,110 @@
+"""file_sampling
+Reproducible selection of a fraction of the glider files of a deployment.
+
+The files are put in time order by the timestamp in their names and split
+into as many consecutive strata as files are wanted, and one file is drawn
+from each stratum with a seeded random generator. The selection covers the
+whole deployment evenly, never holds a file twice and is the same on every
+run.
+
+The selection can be cached in a JSON file. On a rerun the cached files are
+kept wherever they fall in a stratum, so files already staged and converted
+are reused, and new files are only drawn for the strata without one, e.g.
+when the fraction is raised or files are added to a live deployment.
+
+Usage
+-----
+files = sample_files(glob.glob(full_path + '/*.EBD'), 0.1,
+                     cache_path=input_path + 'selection.json')
+"""
+import os
+import re
+import json
+
+import numpy as np
+
+# <glider>-<year>-<day of year>-<mission>-<segment>, e.g.
+# ce_559-2021-043-1-5.ebd, or ce_559-2021-043-1-5.tbd.nc once converted
+LONG_NAME = re.compile(r'(\d{4})-(\d{1,3})-(\d+)-(\d+)(?:\.\w+)+$')
+# 8.3 names, <mission><segment>, e.g. 00340012.EBD
+SHORT_NAME = re.compile(r'^(\d{4})(\d{4})(?:\.\w+)+$')
+
+
+def file_time_key(path):
+    """Sort key that puts glider files in time order by the timestamp in
+    their names: (year, day of year, mission, segment) for long file names
+    and (mission, segment) for 8.3 names. Other names sort after them by
+    name."""
+    name = os.path.basename(path)
+    match = LONG_NAME.search(name)
+    if match:
+        return (0,) + tuple(int(x) for x in match.groups()) + (name,)
+    match = SHORT_NAME.match(name)
+    if match:
+        return (1,) + tuple(int(x) for x in match.groups()) + (name,)
+    return (2, name)
+
+
+def load_selection(cache_path):
+    """Base names of the files in a cached selection, or an empty list if
+    there is no cache."""
+    if cache_path is None or not os.path.exists(cache_path):
+        return []
+    with open(cache_path, 'r') as fid:
+        return json.load(fid)['selected']
+
+
+def save_selection(cache_path, selected, seed):
+    """Writes the base names of the selected files to the cache."""
+    with open(cache_path, 'w') as fid:
+        json.dump({'seed': seed, 'selected': selected}, fid, indent=1)
+
+
+def sample_files(files, fraction, seed=0, cache_path=None):
+    """
+    Selects a fraction of the files, one from each of a set of consecutive
+    time strata, as described in the module docstring.
+
+    Parameters
+    ----------
+    files : list of str
+        Glider files of the deployment, in any order
+    fraction : Scalar.
+        Fraction of the files to select, e.g. the notebook decimation_factor.
+        At least one file is selected
+    seed : int, optional.
+        Seed of the random generator. Default is 0
+    cache_path : str, optional.
+        JSON file to keep the selection in. Files selected on earlier runs
+        are kept, and newly selected files are added to it
+
+    Returns
+    -------
+    selected : list of str
+        The selected files, in time order
+    """
+    files = sorted(set(files), key=file_time_key)
+    if not files:
+        return []
+    n_selected = min(len(files), max(1, int(round(len(files) * fraction))))
+    cached = load_selection(cache_path)
+    rank = dict((name, k) for k, name in enumerate(cached))
+
+    rng = np.random.default_rng(seed)
+    selected = []
+    for stratum in np.array_split(np.arange(len(files)), n_selected):
+        # draw for every stratum, so that a stratum's draw doesn't depend on
+        # which of the strata before it were cached
+        drawn = files[stratum[rng.integers(len(stratum))]]
+        reuse = [files[k] for k in stratum
+                 if os.path.basename(files[k]) in rank]
+        if reuse:
+            drawn = min(reuse, key=lambda f: rank[os.path.basename(f)])
+        selected.append(drawn)
+
+    if cache_path is not None:
+        new = [os.path.basename(f) for f in selected
+               if os.path.basename(f) not in rank]
+        if new:
+            save_selection(cache_path, cached + new, seed)
+    return selected
@@ -0,0 +1,174 @@
+"""file_staging
+Copies a list of glider files (e.g. the selected EBD files of a deployment)
+into a local processing directory in one batched transfer.
+
+Files on a mounted volume are copied by a pool of threads. Files on a remote
+host (`host:/path/file`) are transferred by a single rsync per source
+directory with --files-from, so the SSH connection and rsync start up are paid
+once rather than once per file. Files that are already staged with the same
+size and modification time are skipped, and the number of bytes and the
+throughput of the transfer are reported.
+
+Usage
+-----
+python file_staging.py /Volumes/data/.../science/*.EBD --destination input/
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StagingReport(namedtuple('StagingReport', [
+        'files', 'transferred', 'skipped', 'nbytes', 'seconds'])):
+    """
+    Summary of a stage_files call.
+
+    files : list of str
+        Staged paths, in the order of the requested files
+    transferred : int
+        Number of files copied
+    skipped : int
+        Number of files already staged
+    nbytes : int
+        Bytes copied
+    seconds : float
+        Wall time of the transfer
+    """
+
+    @property
+    def throughput(self):
+        """Bytes copied per second."""
+        return self.nbytes / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return ("Staged {:d} files ({:d} copied, {:d} already staged), "
+                "{:.1f} MB in {:.1f} s ({:.1f} MB/s)".format(
+                    len(self.files), self.transferred, self.skipped,
+                    self.nbytes / 1e6, self.seconds, self.throughput / 1e6))
+
+
+def is_remote(path):
+    """Whether a path is an rsync remote path, `[user@]host:path`."""
+    head = path.split('/', 1)[0]
+    return ':' in head and not os.path.exists(path)
+
+
+def _snapshot(path):
+    """(size, mtime in whole seconds) of a file, or None if it doesn't
+    exist. Whole seconds because not every file system (or rsync) keeps
+    sub-second times."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, int(stat.st_mtime)
+
+
+def is_staged(source, target):
+    """Whether a local source file has already been staged to `target` with
+    the same size and modification time."""
+    staged = _snapshot(target)
+    return staged is not None and staged == _snapshot(source)
+
+
+def _copy_files(pairs, workers):
+    """Copies (source, target) pairs with a thread pool, keeping the
+    modification times."""
+    with ThreadPoolExecutor(workers) as pool:
+        # list() to raise the first failed copy, if any
+        list(pool.map(lambda pair: shutil.copy2(*pair), pairs))
+
+
+def _rsync_files(sources, destination, rsync):
+    """Transfers remote files with one rsync --files-from per source
+    directory."""
+    directories = {}
+    for source in sources:
+        directory, name = source.rsplit('/', 1)
+        directories.setdefault(directory, []).append(name)
+    for directory, names in directories.items():
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as listing:
+            listing.write('\n'.join(names) + '\n')
+            listing.flush()
+            subprocess.run([rsync, '-a', '--files-from=' + listing.name,
+                            directory + '/', destination + '/'],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           check=True)
+
+
+def stage_files(sources, destination, workers=8, rsync='rsync'):
+    """
+    Copies files into a local directory in one batch, skipping the files
+    that are already there.
+
+    Parameters
+    ----------
+    sources : list of str
+        Files to stage, either local paths (e.g. on a mounted volume) or
+        rsync remote paths, `[user@]host:path`. Duplicates are staged once
+    destination : str
+        Directory to stage the files to, created if needed. Files are staged
+        under their base names
+    workers : int, optional
+        Number of files copied at once from a mounted volume. Default is 8
+    rsync : str, optional
+        rsync program, used for remote files. Default is 'rsync'
+
+    Returns
+    -------
+    report : StagingReport
+    """
+    os.makedirs(destination, exist_ok=True)
+    sources = list(dict.fromkeys(sources))
+    targets = [os.path.join(destination, os.path.basename(s))
+               for s in sources]
+    start = time.perf_counter()
+
+    local = [(s, t) for s, t in zip(sources, targets) if not is_remote(s)]
+    remote = [(s, t) for s, t in zip(sources, targets) if is_remote(s)]
+    pending = [(s, t) for s, t in local if not is_staged(s, t)]
+    if pending:
+        _copy_files(pending, workers)
+    nbytes = sum(os.path.getsize(t) for _, t in pending)
+    transferred = len(pending)
+
+    if remote:
+        # rsync skips the files that are up to date itself, so compare the
+        # staged files before and after to see which were transferred
+        before = [_snapshot(t) for _, t in remote]
+        _rsync_files([s for s, _ in remote], destination, rsync)
+        for (_, target), old in zip(remote, before):
+            new = _snapshot(target)
+            if new != old:
+                transferred += 1
+                nbytes += new[0]
+
+    return StagingReport(targets, transferred, len(sources) - transferred,
+                         nbytes, time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Copies glider files to a local directory in one "
+                        "batch, skipping files already staged")
+    parser.add_argument('sources', nargs='+',
+                        help="files to stage, local or [user@]host:path")
+    parser.add_argument('--destination', required=True,
+                        help="directory to stage the files to")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="number of files copied at once from a mounted "
+                             "volume")
+    parser.add_argument('--rsync', default='rsync', help="rsync program")
+    args = parser.parse_args(argv)
+
+    print(stage_files(args.sources, args.destination, workers=args.workers,
+                      rsync=args.rsync))
+
+
+if __name__ == '__main__':
+    main()
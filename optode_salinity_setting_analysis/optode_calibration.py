@@ -0,0 +1,324 @@
+"""optode_calibration
+Calibration sets for an Aanderaa 4831 Oxygen Optode, loaded once from the
+`config_*.json` files used by the processing notebook.
+
+A config file holds one calibration:
+
+    {
+        "calculation_type": "SVU",
+        "SVUFoilCoef": [...],
+        "ConcCoef": [0.0, 1.0],
+        "firmware_version": "5.2.9"
+    }
+
+with "C", "FoilPolyDegT" and "FoilPolyDegO" in place of "SVUFoilCoef" for
+the MkII calculation. A calibration that changes during a deployment (e.g.
+a new ConcCoef after a secondary calibration) is given as a list of
+"segments", each with a "start" time (ISO 8601 or epoch seconds) and the keys
+that change from that time onward:
+
+    "segments": [
+        {"start": "2020-06-01T00:00:00", "ConcCoef": [-0.4, 1.03]}
+    ]
+
+Samples are assigned to segments through the sorted breakpoints, so only one
+set of coefficients per segment is kept in memory rather than one per sample.
+"""
+import json
+
+import numpy as np
+
+import oxygen_calculation as oc
+
+# Optode firmware versions that use the ideal gas constant in the MkII
+# calculation (see calc_o2)
+IDEAL_GAS_FIRMWARES = ("1.25.2",)
+
+CALIBRATION_KEYS = ("calculation_type", "C", "FoilPolyDegT", "FoilPolyDegO",
+                    "SVUFoilCoef", "ConcCoef", "firmware_version", "PhaseCoef")
+
+
+def to_epoch_seconds(start):
+    """Converts a segment start time, either epoch seconds or an ISO 8601
+    string, to epoch seconds."""
+    if isinstance(start, str):
+        start = np.datetime64(start.rstrip('Z'), 'us')
+        return (start - np.datetime64(0, 'us')) / np.timedelta64(1, 's')
+    return float(start)
+
+
+def _select(x, samples):
+    """Selects samples from a per-sample array, passing scalars through."""
+    if np.ndim(x) == 0 or len(x) == 1:
+        return x
+    return x[samples]
+
+
+class CalibrationSegment(object):
+    """
+    One set of optode calibration coefficients, with the constants derived
+    from them computed up front.
+
+    Parameters
+    ----------
+    calculation_type : "SVU" or "MkII"
+    C, FoilPolyDegT, FoilPolyDegO : Array, optional.
+        MkII foil coefficients and exponents
+    SVUFoilCoef : Array, optional.
+        7 SVU foil coefficients
+    ConcCoef : Array, optional.
+        Concentration adjustment coefficients. Default is [0, 1]
+    firmware_version : String, optional.
+        Optode firmware version, which determines the gas constant used by
+        the MkII calculation
+    PhaseCoef : Array, optional.
+        Coefficients for calculating CALPHASE from TCPHASE
+    start : Scalar. [epoch seconds]
+        Time the calibration applies from
+    """
+
+    def __init__(self, calculation_type, C=None, FoilPolyDegT=None,
+                 FoilPolyDegO=None, SVUFoilCoef=None, ConcCoef=(0, 1),
+                 firmware_version=None, PhaseCoef=None, start=-np.inf):
+        if calculation_type not in ("SVU", "MkII"):
+            raise ValueError("calculation_type must be 'SVU' or 'MkII', not %r"
+                             % calculation_type)
+        self.calculation_type = calculation_type
+        self.firmware_version = firmware_version
+        self.start = start
+        self.conc_coef = np.asarray(ConcCoef, dtype=float)
+        self.phase_coef = (None if PhaseCoef is None
+                           else np.asarray(PhaseCoef, dtype=float))
+        self.idealgc = firmware_version in IDEAL_GAS_FIRMWARES
+        if calculation_type == "SVU":
+            if SVUFoilCoef is None:
+                raise ValueError("the SVU calculation requires SVUFoilCoef")
+            self.csv = np.asarray(SVUFoilCoef, dtype=float)
+        else:
+            if C is None or FoilPolyDegT is None or FoilPolyDegO is None:
+                raise ValueError("the MkII calculation requires C, "
+                                 "FoilPolyDegT and FoilPolyDegO")
+            self.C = np.asarray(C, dtype=float)
+            self.M = np.asarray(FoilPolyDegT)
+            self.N = np.asarray(FoilPolyDegO)
+            self.foil = oc.FoilPolynomial(self.C, self.M, self.N)
+
+    def calc_o2(self, calphase, temp, salt=0.0):
+        """DOCONCS_L1 [uM] from calphase and optode temperature, as SVU or
+        calc_o2 would calculate it."""
+        if self.calculation_type == "SVU":
+            return oc.SVU(calphase, temp, self.csv, self.conc_coef, SP=salt)
+        return oc.calc_o2(calphase, temp, self.foil, cc=self.conc_coef,
+                          S=salt, idealgc=self.idealgc)[0]
+
+    def calphase_from_rph(self, c1rph, c2rph):
+        """CALPHASE [deg] recalculated from the blue and red excitation light
+        phases, see oxygen_calculation.calphase_from_rph."""
+        if self.phase_coef is None:
+            raise ValueError("this calibration has no PhaseCoef")
+        return oc.calphase_from_rph(c1rph, c2rph, self.phase_coef)
+
+    def calc_o2_batch(self, calphase, temp, T, SP, P, lat, lon, salt=0.0,
+                      **kwargs):
+        """DOCONCS_L1 [uM] and DOXYGEN_L2 [umol/kg] in one pass, see
+        oxygen_calculation.calc_o2_batch."""
+        return oc.calc_o2_batch(calphase, temp, T, SP, P, lat, lon,
+                                conc_coef=self.conc_coef, salt=salt,
+                                **dict(self._coefs(), **kwargs))
+
+    def calc_o2_sweep(self, calphase, temp, settings, T=None, SP=None,
+                      P=None, lat=None, lon=None, **kwargs):
+        """DOCONCS_L1 [uM] and, given CTD data, DOXYGEN_L2 [umol/kg] for a
+        range of optode salinity settings, see
+        oxygen_calculation.calc_o2_sweep."""
+        return oc.calc_o2_sweep(calphase, temp, settings, T, SP, P, lat, lon,
+                                conc_coef=self.conc_coef,
+                                **dict(self._coefs(), **kwargs))
+
+    def _coefs(self):
+        """The calibration coefficients as keyword arguments for the
+        oxygen_calculation batch functions."""
+        if self.calculation_type == "SVU":
+            return dict(csv=self.csv)
+        return dict(C=self.foil, idealgc=self.idealgc)
+
+
+class OptodeCalibration(object):
+    """
+    The calibration of an optode over a deployment, as one or more
+    CalibrationSegments that each apply from their start time until the next
+    one starts.
+
+    Usage
+    -----
+    cal = OptodeCalibration.from_json(config_dir + 'config_0436_SVU.json')
+    DO = cal.calc_o2(calphase, oxytemp, time=scitime, salt=0)
+
+    Parameters
+    ----------
+    segments : list of CalibrationSegment
+        Calibrations in the order they apply. The first one also applies to
+        any samples before its start time.
+    """
+
+    def __init__(self, segments):
+        if not segments:
+            raise ValueError("a calibration needs at least one segment")
+        self.segments = sorted(segments, key=lambda segment: segment.start)
+        self.breakpoints = np.array([s.start for s in self.segments[1:]])
+
+    @classmethod
+    def from_config(cls, config):
+        """Builds a calibration from a config dictionary, as described in the
+        module docstring."""
+        base = dict((key, config[key]) for key in CALIBRATION_KEYS
+                    if key in config)
+        segments = [CalibrationSegment(**base)]
+        for change in config.get("segments", []):
+            keys = dict(base)
+            keys.update((key, change[key]) for key in CALIBRATION_KEYS
+                        if key in change)
+            segments.append(CalibrationSegment(
+                    start=to_epoch_seconds(change["start"]), **keys))
+        return cls(segments)
+
+    @classmethod
+    def from_json(cls, path):
+        """Loads a calibration from a `config_*.json` file."""
+        with open(path, 'r') as fid:
+            return cls.from_config(json.load(fid))
+
+    def __repr__(self):
+        return "OptodeCalibration(%s, %d segment%s)" % (
+                self.segments[0].calculation_type, len(self.segments),
+                "" if len(self.segments) == 1 else "s")
+
+    def segment_index(self, time):
+        """Index of the segment that applies to each sample time
+        [epoch seconds]."""
+        return np.searchsorted(self.breakpoints, time, side='right')
+
+    def _segment_samples(self, n, time):
+        """Yields each segment with the samples it applies to, as a slice when
+        the times are sorted and as an index array otherwise."""
+        if time is None or len(self.segments) == 1:
+            yield self.segments[0], slice(0, n)
+            return
+        time = np.asarray(time)
+        if np.all(time[1:] >= time[:-1]):
+            bounds = np.concatenate((
+                    [0], np.searchsorted(time, self.breakpoints, side='left'),
+                    [n]))
+            for k, segment in enumerate(self.segments):
+                if bounds[k + 1] > bounds[k]:
+                    yield segment, slice(bounds[k], bounds[k + 1])
+            return
+        index = self.segment_index(time)
+        for k, segment in enumerate(self.segments):
+            samples = np.flatnonzero(index == k)
+            if len(samples):
+                yield segment, samples
+
+    def calc_o2(self, calphase, temp, time=None, salt=0.0):
+        """
+        Calculates DOCONCS_L1 oxygen concentration [uM] from calphase and
+        optode temperature, using the calibration that applies at each sample
+        time.
+
+        Parameters
+        ----------
+        calphase : Array. [deg]
+            Optode raw data output parameter CALPHASE
+        temp : Array. [deg C]
+            Optode thermistor TEMPERATURE
+        time : Array, optional. [epoch seconds]
+            Sample times. Required when the calibration has more than one
+            segment
+        salt : Scalar, optional. [PSU]
+            The SALINITY parameter preset in the optode. Default is 0.0
+
+        Returns
+        -------
+        DO : Array. [micro-moles/L]
+        """
+        calphase = np.atleast_1d(np.asarray(calphase, dtype=float))
+        temp = np.broadcast_to(np.asarray(temp, dtype=float), calphase.shape)
+        self._check_time(time)
+        DO = np.empty(len(calphase))
+        for segment, samples in self._segment_samples(len(calphase), time):
+            DO[samples] = segment.calc_o2(calphase[samples], temp[samples],
+                                          salt=salt)
+        return DO
+
+    def calc_o2_batch(self, calphase, temp, T, SP, P, lat, lon, time=None,
+                      salt=0.0, out=None, **kwargs):
+        """
+        Calculates DOCONCS_L1 [uM] and DOXYGEN_L2 [umol/kg] oxygen in one
+        pass, using the calibration that applies at each sample time. See
+        oxygen_calculation.calc_o2_batch for the parameters.
+
+        Returns
+        -------
+        A tuple of DO and DOc.
+        """
+        calphase = np.atleast_1d(np.asarray(calphase, dtype=float))
+        n = len(calphase)
+        self._check_time(time)
+        temp, T, SP, P = (np.broadcast_to(np.asarray(x, dtype=float), (n,))
+                          for x in (temp, T, SP, P))
+        if out is None:
+            out = (np.empty(n), np.empty(n))
+        DO, DOc = out
+        for segment, samples in self._segment_samples(n, time):
+            if isinstance(samples, slice):
+                # write straight into the output through views
+                segment_out = (DO[samples], DOc[samples])
+            else:
+                segment_out = None
+            result = segment.calc_o2_batch(
+                    calphase[samples], temp[samples], T[samples], SP[samples],
+                    P[samples], _select(lat, samples), _select(lon, samples),
+                    salt=salt,
+                    out=segment_out, **kwargs)
+            if segment_out is None:
+                DO[samples], DOc[samples] = result
+        return DO, DOc
+
+    def calc_o2_sweep(self, calphase, temp, settings, T=None, SP=None,
+                      P=None, lat=None, lon=None, time=None, **kwargs):
+        """
+        Calculates DOCONCS_L1 [uM] and, given CTD data, DOXYGEN_L2 [umol/kg]
+        oxygen for a range of optode salinity settings at once, using the
+        calibration that applies at each sample time. See
+        oxygen_calculation.calc_o2_sweep for the parameters.
+
+        Returns
+        -------
+        A tuple of DO and DOc, each len(settings) x len(calphase). DOc is
+        None without the CTD data.
+        """
+        calphase = np.atleast_1d(np.asarray(calphase, dtype=float))
+        n = len(calphase)
+        self._check_time(time)
+        temp = np.broadcast_to(np.asarray(temp, dtype=float), (n,))
+        T, SP, P = (None if x is None
+                    else np.broadcast_to(np.asarray(x, dtype=float), (n,))
+                    for x in (T, SP, P))
+        shape = (len(np.atleast_1d(settings)), n)
+        DO = np.empty(shape)
+        DOc = None if T is None else np.empty(shape)
+        for segment, samples in self._segment_samples(n, time):
+            DO_segment, DOc_segment = segment.calc_o2_sweep(
+                    calphase[samples], temp[samples], settings,
+                    _select(T, samples), _select(SP, samples),
+                    _select(P, samples), _select(lat, samples),
+                    _select(lon, samples), **kwargs)
+            DO[:, samples] = DO_segment
+            if DOc is not None:
+                DOc[:, samples] = DOc_segment
+        return DO, DOc
+
+    def _check_time(self, time):
+        if time is None and len(self.segments) > 1:
+            raise ValueError("sample times are required for a calibration "
+                             "with more than one segment")
@@ -18,15 +18,40 @@ Revision History
         functions to use separately, and rewrote the main function in terms of
         the sub-functions.
 """
+import math
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 import gsw
 
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 # Global definitions
 KELVIN_OFFSET = 273.15  # The offset to convert temperature Celsius to Kelvin
 ST_K = 298.15  # Standard Temperature in Kelvin. 25.0 deg C = 298.15 deg K
 
+# Garcia and Gordon (1992) coefficients, highest order first for Horner's
+# scheme in the batch calculations
+GG_A = (1.71069, 9.78188e-1, 4.80299, 3.99063, 3.22400, 2.00856)
+GG_B = (-4.29155e-3, -6.90358e-3, -6.93498e-3, -6.24097e-3)
+GG_C0 = -3.11680e-7
+
+# Most bytes of potential density results kept by potential_density. A
+# result larger than this is returned without being kept
+DENSITY_CACHE_BYTES = 64 * 2**20
+_density_cache = OrderedDict()
 
-def calc_o2(cph, tmp, C, M, N, cc=(0, 1), S=0.0,
+
+def calc_o2(cph, tmp, C, M=None, N=None, cc=(0, 1), S=0.0,
             NomAirPress=1013.25, NomAirMix=0.20946, idealgc=False):
     """Calculates oxygen concentration (uncorrected for salinity* or pressure)
     from raw data parameters calphase and temperature from an Aanderaa 4831
@@ -52,7 +77,8 @@ def calc_o2(cph, tmp, C, M, N, cc=(0, 1), S=0.0,
     temp : Temperature, Array/Scalar. [deg C]
         Optode thermistor TEMPERATURE measured near the foil
     C : Sensing Foil Coefficients. Array.
-        Optode calibration parameters FOILCOEFA and FOILCOEFB concatenated
+        Optode calibration parameters FOILCOEFA and FOILCOEFB concatenated.
+        A FoilPolynomial already built from C, M and N can be passed instead
     M : Partial Pressure Polynomial Temperature Exponents. Array.
         Optode calibration parameters FOILPOLYDEGT
     N : Partial Pressure Polynomial Phase Exponents. Array.
@@ -199,7 +225,7 @@ def temp_from_rawtemp(rawtemp, tempCoefs):
     return temp
 
 
-def partial_pressure(cph, tmp, C, M, N):
+def partial_pressure(cph, tmp, C, M=None, N=None):
     """
     Calculates partial pressure [hPa] from calphase and temperature for an
     Aanderaa 4831 oxygen optode using calibration parameters determined for the
@@ -223,6 +249,9 @@ def partial_pressure(cph, tmp, C, M, N):
     N = array-like.
         Optode calibration coefficient `FoilPolyDegO`
 
+    A FoilPolynomial already built from C, M and N can be passed as `C`
+    instead, to reuse it between calls.
+
     Returns
     -------
     PP = array-like or scalar. [hPa]
@@ -238,15 +267,118 @@ def partial_pressure(cph, tmp, C, M, N):
     ----------------
         2019-03-07: Stuart Pearce. Initial Code.
     """
-    C = np.atleast_1d(C)
-    M = np.atleast_1d(M)
-    N = np.atleast_1d(N)
-    # initialize container to be the same size as calphase
-    partialpress = np.zeros_like(cph)
-    # Partial pressure is a polynomial summation calculated here in a for loop
-    for ii in range(len(C)):
-        partialpress = partialpress + C[ii] * tmp**M[ii] * cph**N[ii]
-    return partialpress
+    foil = C if isinstance(C, FoilPolynomial) else FoilPolynomial(C, M, N)
+    return foil(cph, tmp)
+
+
+class FoilPolynomial(object):
+    """
+    Evaluator for the MkII foil polynomial of an Aanderaa 4831 oxygen optode,
+    built once per calibration and reused for every batch of data.
+
+    The polynomial sum(C[i] * temp**M[i] * calphase**N[i]) is rearranged as
+    temp_powers.T @ K @ calphase_powers, where K is the coefficient matrix
+    indexed by temperature and phase exponent. The distinct powers of
+    temperature and calphase are built by repeated multiplication, and the
+    contraction with K is a single matrix product per chunk of samples.
+
+    Usage
+    -----
+    foil = FoilPolynomial(C, M, N)
+    PP = foil(calphase, temp)
+
+    Parameters
+    ----------
+    C = array-like.
+        Optode calibration coefficients *FoilCoefA* and `FoilCoefB`
+        concatenated.
+    M = array-like
+        Optode calibration coefficient *FoilPolyDegT*
+    N = array-like.
+        Optode calibration coefficient `FoilPolyDegO`
+    """
+
+    def __init__(self, C, M, N):
+        self.C = np.atleast_1d(np.asarray(C, dtype=float))
+        self.M = np.atleast_1d(M)
+        self.N = np.atleast_1d(N)
+        # The powers can only be built up by multiplication for non-negative
+        # integer exponents, which is what the optode firmware uses
+        self.integer_exponents = all(
+                np.all(x >= 0) and np.all(x == np.round(x))
+                for x in (self.M, self.N))
+        if self.integer_exponents:
+            M = self.M.astype(int)
+            N = self.N.astype(int)
+            self.K = np.zeros((M.max() + 1, N.max() + 1))
+            np.add.at(self.K, (M, N), self.C)
+
+    def __call__(self, cph, tmp, out=None, chunk_size=65536):
+        """
+        Calculates partial pressure [hPa] from calphase and temperature.
+
+        Parameters
+        ----------
+        calphase = array-like or scalar. [deg]
+            CalPhase, from Optode raw data output
+        temp = array-like or scalar. [deg C]
+            Temperature, from Optode data output
+        out = array, optional.
+            Array the shape of calphase and temp broadcast together to write
+            the partial pressure to
+        chunk_size = integer, optional.
+            Number of samples to evaluate at a time, which bounds the memory
+            used for the powers.
+
+        Returns
+        -------
+        PP = array-like or scalar. [hPa]
+                Partial pressure.
+        """
+        if not self.integer_exponents:
+            partialpress = np.zeros_like(cph)
+            for ii in range(len(self.C)):
+                partialpress = (partialpress
+                                + self.C[ii] * tmp**self.M[ii]
+                                * cph**self.N[ii])
+            if out is not None:
+                out[...] = partialpress
+                return out
+            return partialpress
+
+        shape = np.broadcast(cph, tmp).shape
+        cph, tmp = (np.broadcast_to(x, shape).ravel() for x in (cph, tmp))
+        if out is None:
+            out = np.empty(shape)
+        flat = out.reshape(-1)
+
+        n = len(flat)
+        chunk_size = max(1, min(chunk_size, n))
+        tpow = np.empty((self.K.shape[0], chunk_size))
+        ppow = np.empty((self.K.shape[1], chunk_size))
+        tk = np.empty((self.K.shape[1], chunk_size))
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            size = stop - start
+            _powers(tmp[start:stop], tpow[:, :size])
+            _powers(cph[start:stop], ppow[:, :size])
+            np.matmul(self.K.T, tpow[:, :size], out=tk[:, :size])
+            np.einsum('jn,jn->n', tk[:, :size], ppow[:, :size],
+                      out=flat[start:stop])
+        if out.ndim == 0:
+            return out[()]
+        return out
+
+
+def _powers(x, out):
+    """Writes x**0 ... x**(len(out) - 1) to the rows of `out` by repeated
+    multiplication."""
+    out[0] = 1.
+    if len(out) > 1:
+        out[1] = x
+    for k in range(2, len(out)):
+        np.multiply(out[k - 1], x, out=out[k])
+    return out
 
 
 def vapor_pressure(temp):
@@ -556,6 +688,77 @@ def do2_SVU(calphase, temp, csv, conc_coef=np.array([0.0, 1.0]), salt=0):
     return DO
 
 
+def _potential_density(SP, P, T, lat, lon, pref=0):
+    """Potential density [kg/m3] from the GSW toolbox."""
+    SA = gsw.SA_from_SP(SP, P, lon, lat)
+    CT = gsw.CT_from_t(SA, T, P)
+    return gsw.rho(SA, CT, pref)
+
+
+def _density_key(*args):
+    """Cache key for potential_density: a digest of the shape, dtype and
+    contents of each argument."""
+    digest = hashlib.blake2b(digest_size=20)
+    for x in args:
+        x = np.ascontiguousarray(x, dtype=float)
+        digest.update(repr(x.shape).encode())
+        digest.update(x)
+    return digest.digest()
+
+
+def potential_density(SP, P, T, lat, lon, pref=0):
+    """
+    Potential density of seawater [kg/m3] from the GSW toolbox, cached for
+    the salinity setting sweeps.
+
+    The GSW calls are by far the most expensive part of the salinity and
+    pressure correction, and in salinity setting analyses the same CTD data
+    is corrected over and over. The most recent results, up to
+    DENSITY_CACHE_BYTES in all, are therefore kept, keyed by a hash of the
+    inputs, and returned as read-only arrays when the same CTD data is seen
+    again. Only the sweep functions use the cache; do2_salinity_correction
+    computes the density every call. Call clear_density_cache to free it.
+
+    Parameters
+    ----------
+    SP : Array. [unitless]
+        Practical salinity, PRACSAL
+    P : Array. [dbar]
+        Water pressure, PRESWAT
+    T : Array. [deg C]
+        Water temperature, TEMPWAT
+    lat, lon : Array/Scalar. [degrees]
+        Latitude and longitude of the instrument
+    pref : Scalar, optional. [dbar]
+        Pressure reference level for potential density. Default is 0
+
+    Returns
+    -------
+    pdens : Array. [kg/m3]
+    """
+    key = _density_key(SP, P, T, lat, lon, pref)
+    pdens = _density_cache.get(key)
+    if pdens is not None:
+        _density_cache.move_to_end(key)
+        return pdens
+    pdens = np.asarray(_potential_density(
+            np.asarray(SP, dtype=float), np.asarray(P, dtype=float),
+            np.asarray(T, dtype=float), lat, lon, pref))
+    if pdens.nbytes > DENSITY_CACHE_BYTES:
+        return pdens
+    pdens.flags.writeable = False
+    _density_cache[key] = pdens
+    nbytes = sum(x.nbytes for x in _density_cache.values())
+    while nbytes > DENSITY_CACHE_BYTES:
+        nbytes -= _density_cache.popitem(last=False)[1].nbytes
+    return pdens
+
+
+def clear_density_cache():
+    """Empties the potential_density cache."""
+    _density_cache.clear()
+
+
 def do2_salinity_correction(DO, P, T, SP, lat, lon, pref=0):
     """
     Description:
@@ -613,9 +816,7 @@ def do2_salinity_correction(DO, P, T, SP, lat, lon, pref=0):
     """
 
     # density calculation from GSW toolbox
-    SA = gsw.SA_from_SP(SP, P, lon, lat)
-    CT = gsw.CT_from_t(SA, T, P)
-    pdens = gsw.rho(SA, CT, pref)  # potential referenced to p=0
+    pdens = _potential_density(SP, P, T, lat, lon, pref)
 
     # Convert from volume to mass units:
     DO = 1000*DO/pdens
@@ -636,6 +837,205 @@ def do2_salinity_correction(DO, P, T, SP, lat, lon, pref=0):
     return DO
 
 
+def do2_salinity_correction_sweep(DO, P, T, SP, lat, lon, temp, settings,
+                                  conc_coef=(0, 1), salt=0.0, pref=0):
+    """
+    Calculates DOXYGEN_L2 for a range of optode salinity settings at once,
+    from DOCONCS_L1 reported with one setting.
+
+    The optode applies its SALINITY setting as a factor
+    exp(S*Bts + C0*S**2) of its own temperature before the ConcCoef
+    adjustment, so DOCONCS_L1 under another setting only needs that factor
+    swapped. The density and the CTD salinity and pressure correction are the
+    same for every setting and are computed once (the density through the
+    potential_density cache), so each additional setting costs one
+    exponential per sample.
+
+    Parameters
+    ----------
+    DO : Array. [micro-moles/L]
+        DOCONCS_L1 calculated with the optode salinity setting `salt`
+    P, T, SP, lat, lon : Array/Scalar.
+        Co-located CTD data and position, as for do2_salinity_correction
+    temp : Array. [deg C]
+        Optode thermistor temperature
+    settings : Array. [PSU]
+        Optode salinity settings to calculate DOXYGEN_L2 for
+    conc_coef : Array, optional.
+        ConcCoef used to calculate `DO`, either 2 elements or len(DO)x2.
+        Default is (0, 1)
+    salt : Scalar, optional. [PSU]
+        The optode salinity setting `DO` was calculated with. Default is 0.0
+    pref : Scalar, optional. [dbar]
+        Pressure reference level for potential density. Default is 0
+
+    Returns
+    -------
+    DOc : Array, len(settings) x len(DO). [micro-moles/kg]
+        DOXYGEN_L2 for each salinity setting
+    """
+    DO = np.atleast_1d(np.asarray(DO, dtype=float))
+    n = len(DO)
+    temp, T, SP, P = (np.broadcast_to(np.asarray(x, dtype=float), (n,))
+                      for x in (temp, T, SP, P))
+    settings = np.atleast_1d(np.asarray(settings, dtype=float))
+    conc_coef = np.atleast_2d(np.asarray(conc_coef, dtype=float))
+    cc0, cc1 = conc_coef[:, 0], conc_coef[:, 1]
+
+    # DOCONCS_L1 with no salinity correction and no ConcCoef adjustment
+    bts = _horner(GG_B, _scaled_temperature(temp, np.empty(n)), np.empty(n))
+    raw = (DO - cc0) / cc1 / np.exp(salt*bts + GG_C0*salt**2)
+
+    DOc = _settings_l1(raw, bts, settings, conc_coef,
+                       np.empty((len(settings), n)))
+    DOc *= _l2_factor(P, T, SP, lat, lon, pref)
+    return DOc
+
+
+def oxygen_solubility_sweep(temp, settings):
+    """
+    Oxygen solubility [cm3/dm3] from the Garcia and Gordon equation (1992)
+    for a range of salinities at once, as oxygen_solubility(temp, S) for
+    each S in `settings`. The temperature polynomials are evaluated once and
+    shared by every salinity.
+
+    Parameters
+    ----------
+    temp : Array. [deg C]
+        Temperature, from Optode data output or a co-located CTD
+    settings : Array. [PSU]
+        Salinities, e.g. candidate optode SALINITY settings
+
+    Returns
+    -------
+    oxysol : Array, len(settings) x len(temp). [cm3/dm3]
+    """
+    temp = np.atleast_1d(np.asarray(temp, dtype=float))
+    settings = np.atleast_1d(np.asarray(settings, dtype=float))
+    n = len(temp)
+    ts = _scaled_temperature(temp, np.empty(n))
+    a = _horner(GG_A, ts, np.empty(n))
+    bts = _horner(GG_B, ts, np.empty(n))
+    oxysol = np.multiply.outer(settings, bts)
+    oxysol += GG_C0*settings[:, np.newaxis]**2
+    oxysol += a
+    return np.exp(oxysol, out=oxysol)
+
+
+def calc_o2_sweep(calphase, temp, settings, T=None, SP=None, P=None,
+                  lat=None, lon=None, csv=None, C=None, M=None, N=None,
+                  conc_coef=(0, 1), NomAirPress=1013.25, NomAirMix=0.20946,
+                  idealgc=False, pref=0, out=None):
+    """
+    Calculates DOCONCS_L1 and, given co-located CTD data, DOXYGEN_L2 oxygen
+    for a range of optode salinity settings in one vectorized call, with
+    either the SVU (give `csv`) or the MkII (give `C`, `M` and `N`)
+    calculation.
+
+    The optode salinity setting S only enters the calculation as the factor
+    exp(S*Bts + C0*S**2) of the optode temperature, so the calibration
+    equations, the scaled temperature polynomials and the CTD salinity and
+    pressure correction (with its GSW density) are computed once, and each
+    setting costs one exponential per sample. Row k of the results matches
+    calc_o2_batch with salt=settings[k] to rounding. Without the CTD data
+    only DOCONCS_L1 is calculated, and GSW is not called.
+
+    Usage
+    -----
+    DO, DOc = calc_o2_sweep(calphase, temp, np.arange(0, 36), T, SP, P, lat,
+                            lon, csv=csv, conc_coef=conc_coef)
+    DO, _ = calc_o2_sweep(calphase, temp, [0, 35], csv=csv)
+
+    Parameters
+    ----------
+    calphase, temp : Array.
+        Optode data, as for calc_o2_batch
+    settings : Array. [PSU]
+        Optode SALINITY settings to calculate oxygen for
+    T, SP, P, lat, lon : Array/Scalar, optional.
+        Co-located CTD data and position, as for calc_o2_batch. Give all of
+        them for DOXYGEN_L2, or none for DOCONCS_L1 only
+    csv, C, M, N, conc_coef, NomAirPress, NomAirMix, idealgc, pref : Optional.
+        Calibration coefficients and settings, as for calc_o2_batch
+    out : tuple of 2 Arrays, Optional.
+        Preallocated float64 arrays of len(settings) x len(calphase) to write
+        DO and DOc to (DOc may be None without the CTD data). New arrays are
+        allocated if not given
+
+    Returns
+    -------
+    A tuple of DO and DOc, each len(settings) x len(calphase).
+
+    DO : Dissolved oxygen, Array. [micro-moles/L]
+        DOCONCS_L1 for each salinity setting
+    DOc : Dissolved oxygen, Array. [micro-moles/kg]
+        DOXYGEN_L2 for each salinity setting, None without the CTD data
+    """
+    if csv is None and C is None:
+        raise ValueError("either the SVU (csv) or MkII (C, M, N) calibration "
+                         "coefficients are required")
+    ctd = [x is not None for x in (T, SP, P, lat, lon)]
+    if any(ctd) and not all(ctd):
+        raise ValueError("DOXYGEN_L2 requires all of T, SP, P, lat and lon")
+    calphase = np.atleast_1d(np.asarray(calphase, dtype=float))
+    n = len(calphase)
+    temp = np.broadcast_to(np.asarray(temp, dtype=float), (n,))
+    settings = np.atleast_1d(np.asarray(settings, dtype=float))
+    conc_coef = np.atleast_2d(np.asarray(conc_coef, dtype=float))
+
+    # DOCONCS_L1 with the salinity setting at 0 and before the ConcCoef
+    # adjustment
+    work = [np.empty(n) for _ in range(3)]
+    raw = np.empty(n)
+    if csv is not None:
+        csv = np.atleast_2d(np.asarray(csv, dtype=float))
+        _svu_l1(calphase, temp, csv, 0.0, work, raw)
+    else:
+        foil = C if isinstance(C, FoilPolynomial) else FoilPolynomial(C, M, N)
+        gas_const = 44.615 if idealgc else 44.659
+        _mkii_l1(calphase, temp, foil, 0.0, NomAirPress, NomAirMix,
+                 gas_const, work, raw)
+    bts = _horner(GG_B, _scaled_temperature(temp, work[0]), work[1])
+
+    if out is None:
+        out = (np.empty((len(settings), n)),
+               np.empty((len(settings), n)) if all(ctd) else None)
+    DO, DOc = out
+    _settings_l1(raw, bts, settings, conc_coef, DO)
+    if not all(ctd):
+        return DO, None
+    T, SP, P = (np.broadcast_to(np.asarray(x, dtype=float), (n,))
+                for x in (T, SP, P))
+    np.multiply(DO, _l2_factor(P, T, SP, lat, lon, pref), out=DOc)
+    return DO, DOc
+
+
+def _settings_l1(raw, bts, settings, conc_coef, out):
+    """DOCONCS_L1 for each optode salinity setting, written to the rows of
+    `out`, from the concentration `raw` calculated with the setting at 0 and
+    before the ConcCoef adjustment, and Bts of the optode temperature."""
+    cc0, cc1 = conc_coef[:, 0], conc_coef[:, 1]
+    for row, S in zip(out, settings):
+        np.multiply(bts, S, out=row)
+        np.add(row, GG_C0*S**2, out=row)
+        np.exp(row, out=row)
+        np.multiply(row, raw, out=row)
+        np.multiply(row, cc1, out=row)
+        np.add(row, cc0, out=row)
+    return out
+
+
+def _l2_factor(P, T, SP, lat, lon, pref):
+    """The factor that converts DOCONCS_L1 to DOXYGEN_L2 in
+    do2_salinity_correction: the volume to mass conversion and the pressure
+    and CTD salinity corrections."""
+    n = len(T)
+    factor = _salinity_factor(T, SP, np.empty(n), np.empty(n))
+    factor *= (1 + (0.032*P)/1000) * 1000
+    factor /= potential_density(SP, P, T, lat, lon, pref)
+    return factor
+
+
 def SVU(cal, tmp, calsv, conc_coef=[0, 1], SP=0):
     """Implementation of Aanderaa's version of the
     Sterm-Volmer-Uchida Equation with partial salinity correction
@@ -691,4 +1091,382 @@ def SVU(cal, tmp, calsv, conc_coef=[0, 1], SP=0):
     DOc = np.exp((SP-S0)*Bts + C0*(SP**2-S0**2)) * DOc
     
     DOc = conc_coef[:, 0] + conc_coef[:, 1] * DOc
-    return DOc
\ No newline at end of file
+    return DOc
+
+
+
+def svu_kernel(cal, tmp, calsv, conc_coef=(0, 1), SP=0.0, out=None,
+               engine=None):
+    """
+    SVU oxygen concentration [uM] computed sample by sample in one fused
+    loop, as SVU(cal, tmp, calsv, conc_coef, SP) to rounding.
+
+    With numba installed the loop is compiled and runs over the samples in
+    parallel, without any temporary arrays. Without numba the samples are
+    processed in chunks through a fixed set of buffers with NumPy, as in
+    calc_o2_batch. Scalar calphase and temperature with a single calibration
+    are calculated directly with the math module and return a float, which
+    avoids the array overhead of SVU for sample at a time (real-time) use.
+
+    Parameters
+    ----------
+    cal : calphase: Scalar or Array. [deg]
+        The raw measured output Calibrated Phase from the optode
+    tmp : optode temperature: Scalar or Array. [deg C]
+        Temperature output from the optode's thermistor
+    calsv : SVU calibration parameters: Array.
+        The SVUFoilCoef coefficients, either 7 elements or len(`cal`)x7
+    conc_coef : Array, optional.
+        ConcCoef, either 2 elements or len(`cal`)x2. Default is (0, 1)
+    SP : Scalar, optional. [PSU]
+        The SALINITY parameter preset in the optode. Default is 0.0
+    out : Array, optional.
+        Preallocated float64 array the size of `cal` to write DO to
+    engine : 'numba' or 'numpy', optional.
+        Default is numba if it is installed, numpy otherwise
+
+    Returns
+    -------
+    DO: Molar Dissolved Oxygen concentration. [uM]
+        Not yet compensated for CTD salinity and pressure
+    """
+    if engine is None:
+        engine = 'numpy' if numba is None else 'numba'
+    if engine not in ('numba', 'numpy'):
+        raise ValueError("engine must be 'numba' or 'numpy', not %r" % engine)
+    if engine == 'numba' and numba is None:
+        raise ImportError("the numba engine requires numba to be installed")
+
+    # both engines index the coefficient rows without bounds checks, so the
+    # shapes are checked here
+    scalar = (np.ndim(cal) == 0 and np.ndim(tmp) == 0 and np.ndim(calsv) == 1
+              and np.ndim(conc_coef) == 1 and out is None)
+    cal = np.atleast_1d(np.asarray(cal, dtype=float))
+    n = len(cal)
+    calsv = _coefficient_rows(calsv, 7, n, 'calsv')
+    conc_coef = _coefficient_rows(conc_coef, 2, n, 'conc_coef')
+
+    if scalar:
+        try:
+            return _svu_sample(float(cal[0]), float(tmp),
+                               *calsv[0].tolist(), *conc_coef[0].tolist(),
+                               float(SP))
+        except (ZeroDivisionError, ValueError):
+            # NaN rather than an exception, as the array calculation gives
+            return math.nan
+
+    tmp = np.broadcast_to(np.asarray(tmp, dtype=float), (n,))
+    if out is None:
+        out = np.empty(n)
+    elif out.shape != (n,) or out.dtype != np.float64:
+        raise ValueError("out must be a float64 array of shape (%d,), not %s "
+                         "%s" % (n, out.dtype, out.shape))
+    if engine == 'numba':
+        return _svu_numba(np.ascontiguousarray(cal),
+                          np.ascontiguousarray(tmp), calsv, conc_coef,
+                          float(SP), out)
+    return _svu_numpy(cal, tmp, calsv, conc_coef, SP, out)
+
+
+def _coefficient_rows(coefs, width, n, name):
+    """Coefficients as a 2-D float array of either one row for all `n`
+    samples or one row per sample, `width` columns wide."""
+    coefs = np.atleast_2d(np.asarray(coefs, dtype=float))
+    if coefs.ndim != 2 or coefs.shape[1] != width or (
+            coefs.shape[0] not in (1, n)):
+        raise ValueError("%s must have %d elements or %d rows of %d, not "
+                         "shape %s" % (name, width, n, width, coefs.shape))
+    return coefs
+
+
+def _horner(coefs, x, out):
+    """Evaluates the polynomial with coefficients `coefs` (highest order
+    first) at `x` with Horner's scheme, writing the result to `out`. `out`
+    must not be the same array as `x`."""
+    out[...] = coefs[0]
+    for coef in coefs[1:]:
+        np.multiply(out, x, out=out)
+        np.add(out, coef, out=out)
+    return out
+
+
+def _chunk(x, start, stop):
+    """Slices samples start:stop out of a per-sample array, passing scalars
+    and coefficient rows that apply to every sample through unchanged."""
+    if np.ndim(x) == 0 or len(x) == 1:
+        return x
+    return x[start:stop]
+
+def _scaled_temperature(temp, out):
+    """Garcia and Gordon (1992) scaled temperature, written to `out`."""
+    np.add(temp, KELVIN_OFFSET, out=out)
+    np.divide(ST_K - temp, out, out=out)
+    return np.log(out, out=out)
+
+
+def _salinity_factor(temp, SP, work, out, use_ne=False):
+    """Garcia and Gordon (1992) salinity correction factor
+    exp(SP*Bts + C0*SP**2) at temperature `temp`, written to `out`. `work`
+    is a scratch array the size of `out`."""
+    ts = _scaled_temperature(temp, work)
+    if use_ne:
+        B3, B2, B1, B0 = GG_B
+        ne.evaluate("exp(SP*(B0 + ts*(B1 + ts*(B2 + ts*B3))) + C0*SP**2)",
+                    local_dict=dict(ts=ts, SP=SP, B0=B0, B1=B1, B2=B2, B3=B3,
+                                    C0=GG_C0),
+                    out=out, casting='unsafe')
+        return out
+    _horner(GG_B, ts, out)
+    np.multiply(out, SP, out=out)
+    np.add(out, GG_C0*np.square(SP), out=out)
+    return np.exp(out, out=out)
+
+
+def _svu_l1(cal, tmp, csv, salt, work, out, use_ne=False):
+    """SVU oxygen concentration [uM] before the ConcCoef adjustment, written
+    to `out`. `work` is a list of 2 scratch arrays the size of `out`."""
+    c0, c1, c2, c3, c4, c5, c6 = (csv[:, k] for k in range(7))
+    if use_ne:
+        ne.evaluate("((c3 + c4*tmp)/(c5 + c6*cal) - 1)/(c0 + tmp*(c1 + c2*tmp))",
+                    out=out, casting='unsafe')
+    else:
+        # Ksv = c0 + c1*T + c2*T**2, P0 = c3 + c4*T and Pc = c5 + c6*calphase
+        ksv = _horner((c2, c1, c0), tmp, work[0])
+        pc = work[1]
+        np.multiply(c6, cal, out=pc)
+        np.add(pc, c5, out=pc)
+        np.multiply(c4, tmp, out=out)
+        np.add(out, c3, out=out)
+        np.divide(out, pc, out=out)
+        np.subtract(out, 1, out=out)
+        np.divide(out, ksv, out=out)
+    if np.any(salt != 0):
+        # partial salinity correction using the preset salinity in the optode
+        factor = _salinity_factor(tmp, salt, work[0], work[1], use_ne)
+        np.multiply(factor, out, out=out)
+    return out
+
+
+def _mkii_l1(cal, tmp, foil, salt, NomAirPress, NomAirMix, gas_const,
+             work, out):
+    """MkII oxygen concentration [uM] before the ConcCoef adjustment, written
+    to `out`. `work` is a list of 3 scratch arrays the size of `out`."""
+    a, b, c = work
+    # vapour pressure pvapor(t) and the air saturation it gives
+    np.add(tmp, KELVIN_OFFSET, out=a)
+    np.log(a, out=b)
+    np.multiply(b, 4.6810, out=b)
+    np.divide(6690.9, a, out=a)
+    np.subtract(52.57, a, out=a)
+    np.subtract(a, b, out=a)
+    np.exp(a, out=a)
+    np.subtract(NomAirPress, a, out=a)
+    np.multiply(a, NomAirMix, out=a)
+    foil(cal, tmp, out=out)
+    np.multiply(out, 100., out=out)
+    np.divide(out, a, out=out)
+
+    # Oxygen solubility (cm3/dm3), with the temperature and salinity
+    # polynomials sharing one scaled temperature
+    ts = _scaled_temperature(tmp, a)
+    _horner(GG_A, ts, b)
+    _horner(GG_B, ts, c)
+    np.multiply(c, salt, out=c)
+    np.add(b, c, out=b)
+    np.add(b, GG_C0*salt**2, out=b)
+    np.exp(b, out=b)
+    np.multiply(b, gas_const, out=b)
+
+    np.multiply(b, out, out=out)
+    np.divide(out, 100., out=out)
+    return out
+
+
+def _salinity_pressure_correction(DO, P, T, SP, lat, lon, pref, work, out,
+                                  use_ne=False):
+    """DOXYGEN_L2 [umol/kg] from DOCONCS_L1 [uM] as in
+    do2_salinity_correction, written to `out`. `work` is a list of 2 scratch
+    arrays the size of `out`."""
+    pdens = _potential_density(SP, P, T, lat, lon, pref)
+    factor = _salinity_factor(T, SP, work[0], work[1], use_ne)
+    if use_ne:
+        ne.evaluate("factor*((1 + (0.032*P)/1000)*(1000*DO/pdens))", out=out,
+                    casting='unsafe')
+        return out
+    # volume to mass units, then the pressure and salinity corrections
+    np.multiply(DO, 1000, out=out)
+    np.divide(out, pdens, out=out)
+    np.multiply(P, 0.032, out=work[0])
+    np.divide(work[0], 1000, out=work[0])
+    np.add(work[0], 1, out=work[0])
+    np.multiply(work[0], out, out=out)
+    np.multiply(factor, out, out=out)
+    return out
+
+
+def calc_o2_batch(calphase, temp, T, SP, P, lat, lon, csv=None, C=None,
+                  M=None, N=None, conc_coef=(0, 1), salt=0.0,
+                  NomAirPress=1013.25, NomAirMix=0.20946, idealgc=False,
+                  pref=0, out=None, chunk_size=65536, engine=None):
+    """Calculates both DOCONCS_L1 and DOXYGEN_L2 oxygen for a whole
+    deployment in one pass over the data, with either the SVU (give `csv`) or
+    the MkII (give `C`, `M` and `N`) calculation.
+
+    The samples are processed in chunks of `chunk_size` through a fixed set
+    of scratch buffers, the polynomials are evaluated with Horner's scheme and
+    the scaled temperatures are computed once per chunk. The results match
+    SVU/calc_o2 followed by do2_salinity_correction to rounding.
+
+    Usage
+    -----
+    DO, DOc = calc_o2_batch(calphase, temp, T, SP, P, lat, lon, csv=csv,
+                            conc_coef=conc_coef)
+
+    Parameters
+    ----------
+    calphase : Calibrated_phase, Array. [deg]
+        Optode raw data output parameter CALPHASE
+    temp : Temperature, Array. [deg C]
+        Optode thermistor TEMPERATURE measured near the foil
+    T : Array. [deg C]
+        Co-located CTD water temperature, TEMPWAT
+    SP : Array. [unitless]
+        Co-located CTD practical salinity, PRACSAL
+    P : Array. [dbar]
+        Co-located CTD water pressure, PRESWAT
+    lat, lon : Array/Scalar. [degrees]
+        Latitude and longitude of the instrument
+    csv : SVU calibration coefficients. Array, Optional.
+        Optode calibration parameter SVUFoilCoef, either 7 elements or
+        len(calphase)x7
+    C, M, N : MkII calibration coefficients. Array, Optional.
+        Optode calibration parameters FOILCOEFA and FOILCOEFB concatenated,
+        FOILPOLYDEGT and FOILPOLYDEGO, as for calc_o2. A FoilPolynomial
+        already built from them can be passed as `C` instead
+    conc_coef : Concentration adjustment coefficients. Array, Optional.
+        Optode calibration parameter CONCCOEF, either 2 elements or
+        len(calphase)x2. Default is (0, 1)
+    salt : Salinity configuration parameter. Scalar, Optional. [PSU]
+        The SALINITY parameter preset in the optode. Default is 0.0
+    NomAirPress, NomAirMix, idealgc : Optional.
+        MkII calculation settings, as for calc_o2
+    pref : Scalar, Optional. [dbar]
+        Pressure reference level for potential density. Default is 0
+    out : tuple of 2 Arrays, Optional.
+        Preallocated float64 arrays the size of calphase to write DO and DOc
+        to. New arrays are allocated if not given
+    chunk_size : Integer, Optional.
+        Number of samples processed at a time. Default is 65536
+    engine : 'numpy' or 'numexpr', Optional.
+        Evaluator for the element-wise expressions. Default is numexpr if it
+        is installed, numpy otherwise
+
+    Returns
+    -------
+    A tuple of DO and DOc.
+
+    DO : Dissolved oxygen, Array. [micro-moles/L]
+        DOCONCS_L1, uncorrected for salinity and pressure
+    DOc : Dissolved oxygen, Array. [micro-moles/kg]
+        DOXYGEN_L2, corrected for salinity and pressure
+    """
+    if engine is None:
+        engine = 'numpy' if ne is None else 'numexpr'
+    if engine not in ('numpy', 'numexpr'):
+        raise ValueError("engine must be 'numpy' or 'numexpr', not %r" % engine)
+    if engine == 'numexpr' and ne is None:
+        raise ImportError("the numexpr engine requires numexpr to be installed")
+    use_ne = engine == 'numexpr'
+    if csv is None and C is None:
+        raise ValueError("either the SVU (csv) or MkII (C, M, N) calibration "
+                         "coefficients are required")
+
+    calphase = np.atleast_1d(np.asarray(calphase, dtype=float))
+    n = len(calphase)
+    temp, T, SP, P = (np.broadcast_to(np.asarray(x, dtype=float), (n,))
+                      for x in (temp, T, SP, P))
+    conc_coef = np.atleast_2d(np.asarray(conc_coef, dtype=float))
+    if csv is not None:
+        csv = np.atleast_2d(np.asarray(csv, dtype=float))
+    gas_const = 44.615 if idealgc else 44.659
+    if csv is None:
+        foil = C if isinstance(C, FoilPolynomial) else FoilPolynomial(C, M, N)
+
+    if out is None:
+        out = (np.empty(n), np.empty(n))
+    DO, DOc = out
+
+    chunk_size = max(1, min(chunk_size, n))
+    work = [np.empty(chunk_size) for _ in range(3)]
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        size = stop - start
+        chunk_work = [w[:size] for w in work]
+        cal, tmp = calphase[start:stop], temp[start:stop]
+
+        l1 = DO[start:stop]
+        if csv is not None:
+            _svu_l1(cal, tmp, _chunk(csv, start, stop), salt, chunk_work, l1,
+                    use_ne)
+        else:
+            _mkii_l1(cal, tmp, foil, salt, NomAirPress, NomAirMix,
+                     gas_const, chunk_work, l1)
+        # Calibration adjustment using the ConcCoef calibration coefficents
+        cc = _chunk(conc_coef, start, stop)
+        np.multiply(cc[:, 1], l1, out=l1)
+        np.add(cc[:, 0], l1, out=l1)
+
+        _salinity_pressure_correction(
+                l1, P[start:stop], T[start:stop], SP[start:stop],
+                _chunk(lat, start, stop), _chunk(lon, start, stop), pref,
+                chunk_work, DOc[start:stop], use_ne)
+    return DO, DOc
+
+
+def _svu_sample(cal, tmp, c0, c1, c2, c3, c4, c5, c6, cc0, cc1, salt):
+    """SVU oxygen concentration [uM] of one sample with the math module.
+    Compiled by numba into the loop of _svu_numba when it is installed."""
+    DO = ((c3 + c4*tmp)/(c5 + c6*cal) - 1)/(c0 + tmp*(c1 + tmp*c2))
+    if salt != 0:
+        ts = math.log((ST_K - tmp)/(KELVIN_OFFSET + tmp))
+        bts = GG_B[3] + ts*(GG_B[2] + ts*(GG_B[1] + ts*GG_B[0]))
+        DO *= math.exp(salt*bts + GG_C0*salt*salt)
+    return cc0 + cc1*DO
+
+
+def _svu_numpy(cal, tmp, csv, conc_coef, salt, out, chunk_size=65536):
+    """SVU oxygen concentration [uM] with NumPy, in chunks through a fixed
+    set of buffers, written to `out`."""
+    n = len(cal)
+    chunk_size = max(1, min(chunk_size, n))
+    work = [np.empty(chunk_size) for _ in range(2)]
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        l1 = out[start:stop]
+        _svu_l1(cal[start:stop], tmp[start:stop], _chunk(csv, start, stop),
+                salt, [w[:stop - start] for w in work], l1)
+        cc = _chunk(conc_coef, start, stop)
+        np.multiply(cc[:, 1], l1, out=l1)
+        np.add(cc[:, 0], l1, out=l1)
+    return out
+
+
+if numba is not None:
+    _svu_sample_jit = numba.njit(error_model='numpy')(_svu_sample)
+
+    @numba.njit(parallel=True, error_model='numpy', cache=True)
+    def _svu_numba(cal, tmp, csv, conc_coef, salt, out):
+        """SVU oxygen concentration [uM] of every sample in one parallel
+        loop, written to `out`. `csv` and `conc_coef` have either one row
+        for all samples or one row per sample."""
+        # row strides of 0 or 1 through the coefficients
+        csv_step = min(csv.shape[0] - 1, 1)
+        cc_step = min(conc_coef.shape[0] - 1, 1)
+        for i in numba.prange(cal.shape[0]):
+            k = i * csv_step
+            j = i * cc_step
+            out[i] = _svu_sample_jit(
+                    cal[i], tmp[i], csv[k, 0], csv[k, 1], csv[k, 2],
+                    csv[k, 3], csv[k, 4], csv[k, 5], csv[k, 6],
+                    conc_coef[j, 0], conc_coef[j, 1], salt)
+        return out
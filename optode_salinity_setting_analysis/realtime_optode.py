@@ -0,0 +1,287 @@
+"""realtime_optode
+Incremental DOXYGEN_L2 processor for telemetered glider data.
+
+Each mini-batch of newly arrived records (e.g. the dbd2netCDF output of the
+TBD files sent at a surfacing) is processed as it arrives, with the optode
+calibration held in memory: the CTD values are interpolated to the optode
+sample times, oxygen is calculated (SVU or MkII, then the salinity and
+pressure correction) and the results are appended to a rolling output file.
+Only the records that can't be processed until more data arrives (optode
+samples after the last CTD sample, and the CTD samples needed to interpolate
+them) are kept between batches, so the time per sample stays the same however
+long the deployment runs.
+
+Records sent again are dropped by their times, for as long as they are
+within the window of record times remembered before the latest record (a day
+by default), so the memory kept is bounded too. Records older than the ones
+already processed, e.g. from a TBD file that arrives after later ones, are
+processed on their own with the CTD data they arrived with, and appended to
+the output after the newer samples.
+
+The output file name is a strftime pattern of the sample times, e.g.
+'oxygen_%Y%m%d.nc' starts a new file every day. Files are only open while a
+batch is written, so live plots can read them between surfacings.
+
+Usage
+-----
+python realtime_optode.py 'from-glider/nc/*.tbd.nc' --config config.json
+    --lat 40.1 --lon -70.8 --output 'realtime/oxygen_%Y%m%d.nc' --follow
+"""
+import os
+import glob
+import time
+import argparse
+from datetime import datetime, timezone
+
+import netCDF4
+import numpy as np
+
+from file_sampling import file_time_key
+from optode_calibration import OptodeCalibration
+from stream_optode_data import (INPUT_VARIABLES, OUTPUT_VARIABLES,
+                                create_output, process_chunk, read_chunks)
+
+
+def output_paths(times, pattern):
+    """Output file of each sample time [epoch seconds], from a strftime
+    pattern."""
+    if '%' not in pattern:
+        return [pattern] * len(times)
+    return [datetime.fromtimestamp(t, timezone.utc).strftime(pattern)
+            for t in times]
+
+
+class RealtimeOxygenProcessor(object):
+    """
+    Calculates DOXYGEN_L2 from mini-batches of telemetered records as they
+    arrive and appends it to a rolling output file.
+
+    Usage
+    -----
+    processor = RealtimeOxygenProcessor(calibration, 'oxygen_%Y%m%d.nc',
+                                        lat, lon)
+    for batch in batches:
+        result = processor.update(batch)
+    processor.flush()
+
+    Parameters
+    ----------
+    calibration : OptodeCalibration
+    output : str
+        Output netCDF file, or a strftime pattern of the sample times to
+        start a new file every period, e.g. 'oxygen_%Y%m%d.nc'
+    lat, lon : Scalar. [degrees]
+        Position of the glider
+    salt : Scalar, optional. [PSU]
+        The SALINITY parameter preset in the optode. Default is 0.0
+    max_gap : Scalar, optional. [seconds]
+        Longest gap between CTD samples to interpolate across. Default is 60
+    chunk_size : int, optional
+        netCDF chunk size of new output files. Default is 4096
+    window : Scalar, optional. [seconds]
+        How far back from the latest record the record times are remembered
+        to drop records sent again. Older records sent again are processed
+        again. Default is 86400 (a day)
+    """
+
+    def __init__(self, calibration, output, lat, lon, salt=0.0, max_gap=60.0,
+                 chunk_size=4096, window=86400.0):
+        self.calibration = calibration
+        self.output = output
+        self.lat = lat
+        self.lon = lon
+        self.salt = salt
+        self.max_gap = max_gap
+        self.chunk_size = chunk_size
+        self.window = window
+        self.carry = None
+        # time of the latest record processed in time order; older records
+        # are late
+        self.last_time = -np.inf
+        # sorted times of the records received within `window` of the
+        # latest one, to drop records sent again
+        self.seen = np.array([])
+
+    def update(self, records):
+        """
+        Processes newly arrived records and appends the oxygen to the output.
+
+        Parameters
+        ----------
+        records : dict
+            Arrays of the stream_optode_data INPUT_VARIABLES, NaN where a
+            sensor has no sample. Records at a time already received are
+            dropped, and records older than the ones already processed are
+            processed on their own
+
+        Returns
+        -------
+        result : dict
+            Arrays of the OUTPUT_VARIABLES for the optode samples that could
+            be processed, in time order, e.g. to update a live plot
+        """
+        records = dict((name, np.asarray(records[name], dtype=float))
+                       for name in INPUT_VARIABLES)
+        time = records['time']
+        # the first record at each time, sorted by time
+        _, first = np.unique(time, return_index=True)
+        first = first[np.isfinite(time[first])]
+        first = first[~self._is_seen(time[first])]
+        records = dict((name, values[first])
+                       for name, values in records.items())
+        time = records['time']
+
+        late = time < self.last_time
+        if len(time):
+            self.last_time = max(self.last_time, time[-1])
+            self._remember(time)
+        result = self._process(dict((name, values[~late])
+                                    for name, values in records.items()),
+                               final=False)
+        if not late.any():
+            return result
+        late_result = self._process_late(
+                dict((name, values[late]) for name, values in records.items()))
+        order = np.argsort(np.concatenate((late_result['time'],
+                                           result['time'])), kind='stable')
+        return dict((name, np.concatenate((late_result[name],
+                                           result[name]))[order])
+                    for name in OUTPUT_VARIABLES)
+
+    def _is_seen(self, time):
+        """Whether each of `time` was received in an earlier batch within
+        the window."""
+        if not len(self.seen):
+            return np.zeros(len(time), dtype=bool)
+        index = np.minimum(np.searchsorted(self.seen, time),
+                           len(self.seen) - 1)
+        return self.seen[index] == time
+
+    def _remember(self, time):
+        """Adds the sorted, unseen `time` to the times received and forgets
+        the ones older than the window."""
+        seen = np.concatenate((self.seen, time))
+        if len(self.seen) and time[0] < self.seen[-1]:
+            seen.sort(kind='mergesort')
+        self.seen = seen[np.searchsorted(seen,
+                                         self.last_time - self.window):]
+
+    def _process_late(self, records):
+        """Processes records older than the ones already processed, as a
+        chunk of their own."""
+        result, _ = process_chunk(records, self.calibration, self.lat,
+                                  self.lon, self.salt, self.max_gap,
+                                  final=True)
+        self._write(result)
+        return result
+
+    def flush(self):
+        """Processes the records held back for the next batch, e.g. at the
+        end of a deployment, with the CTD data there is."""
+        empty = dict((name, np.array([])) for name in INPUT_VARIABLES)
+        return self._process(empty, final=True)
+
+    def process(self, batches):
+        """Processes an iterable of record batches as they arrive, yielding
+        the result of each, and flushes at the end."""
+        for records in batches:
+            yield self.update(records)
+        yield self.flush()
+
+    def _process(self, records, final):
+        if self.carry is not None:
+            records = dict((name, np.concatenate((self.carry[name],
+                                                  records[name])))
+                           for name in INPUT_VARIABLES)
+        if not len(records['time']):
+            self.carry = None
+            return dict((name, np.array([])) for name in OUTPUT_VARIABLES)
+        result, self.carry = process_chunk(
+                records, self.calibration, self.lat, self.lon, self.salt,
+                self.max_gap, final=final)
+        self._write(result)
+        return result
+
+    def _write(self, result):
+        """Appends results to the output files of their sample times."""
+        paths = np.array(output_paths(result['time'], self.output))
+        for path in dict.fromkeys(paths):
+            rows = paths == path
+            if os.path.exists(path):
+                out = netCDF4.Dataset(path, 'a')
+            else:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                out = create_output(path, self.chunk_size, self.calibration,
+                                    self.lat, self.lon, self.salt)
+            with out:
+                start = len(out.dimensions['time'])
+                stop = start + np.count_nonzero(rows)
+                for name in OUTPUT_VARIABLES:
+                    out[name][start:stop] = result[name][rows]
+
+
+def follow_files(pattern, interval=60.0, follow=True):
+    """Yields the records of each netCDF file matching a glob pattern, in
+    time order by the timestamp in their names (file_sampling.file_time_key),
+    in batches of up to 100000 records. With `follow`, keeps polling every
+    `interval` seconds for new files."""
+    seen = set()
+    while True:
+        for path in sorted(set(glob.glob(pattern)) - seen, key=file_time_key):
+            seen.add(path)
+            with netCDF4.Dataset(path, 'r') as nc:
+                chunks = list(read_chunks(nc, INPUT_VARIABLES, 100000))
+            for chunk in chunks:
+                yield chunk
+        if not follow:
+            return
+        time.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Calculates DOXYGEN_L2 from telemetered dbd2netCDF "
+                        "files as they arrive")
+    parser.add_argument('pattern',
+                        help="glob pattern of the netCDF files written by "
+                             "dbd2netCDF, in quotes")
+    parser.add_argument('--config', required=True,
+                        help="optode calibration config json")
+    parser.add_argument('--lat', type=float, required=True,
+                        help="latitude of the glider [degrees]")
+    parser.add_argument('--lon', type=float, required=True,
+                        help="longitude of the glider [degrees]")
+    parser.add_argument('--output', required=True,
+                        help="output netCDF file, or a strftime pattern of "
+                             "the sample times, e.g. oxygen_%%Y%%m%%d.nc")
+    parser.add_argument('--salt', type=float, default=0.0,
+                        help="salinity setting of the optode [PSU]")
+    parser.add_argument('--max-gap', type=float, default=60.0,
+                        help="longest gap between CTD samples to interpolate "
+                             "across [seconds]")
+    parser.add_argument('--window', type=float, default=86400.0,
+                        help="how far back from the latest record to drop "
+                             "records sent again [seconds]")
+    parser.add_argument('--follow', action='store_true',
+                        help="keep polling for new files")
+    parser.add_argument('--interval', type=float, default=60.0,
+                        help="seconds between polls with --follow")
+    args = parser.parse_args(argv)
+
+    processor = RealtimeOxygenProcessor(
+            OptodeCalibration.from_json(args.config), args.output, args.lat,
+            args.lon, salt=args.salt, max_gap=args.max_gap,
+            window=args.window)
+    batches = follow_files(args.pattern, args.interval, args.follow)
+    for result in processor.process(batches):
+        if len(result['time']):
+            print("Wrote {:d} oxygen samples up to {:s}".format(
+                    len(result['time']),
+                    datetime.fromtimestamp(result['time'][-1], timezone.utc)
+                    .strftime('%Y-%m-%dT%H:%M:%SZ')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""stream_optode_data
+Streaming DOXYGEN_L2 processor for the netCDF files written by dbd2netCDF from
+glider science (EBD/TBD) files.
+
+The input variables are read a fixed number of records at a time, oxygen is
+calculated for each chunk with oxygen_calculation (calphase -> DOCONCS_L1 ->
+salinity and pressure corrected DOXYGEN_L2), and the results are appended to
+an output netCDF file as they are produced. Peak memory depends on the chunk
+size, not on the length of the deployment.
+
+As in the processing notebook, records where the optode calphase is zero
+(instrument initializing) or missing are dropped. The CTD pressure,
+temperature and salinity are interpolated to the optode sample times with
+time_alignment, without bridging gaps longer than --max-gap seconds.
+
+Usage
+-----
+python stream_optode_data.py input.nc [input.nc ...] output.nc --config config_0436_SVU.json
+    --lat 40.1 --lon -70.8
+"""
+import argparse
+
+import gsw
+import netCDF4
+import numpy as np
+
+from optode_calibration import OptodeCalibration
+from time_alignment import align_ctd
+
+# dbd2netCDF variables read from the input file
+INPUT_VARIABLES = {
+    'time': 'sci_m_present_time',
+    'calphase': 'sci_oxy4_calphase',
+    'optode_temperature': 'sci_oxy4_temp',
+    'temperature': 'sci_water_temp',
+    'conductivity': 'sci_water_cond',
+    'pressure': 'sci_water_pressure',
+    }
+CTD_VARIABLES = ('temperature', 'conductivity', 'pressure')
+
+# variables written to the output file, with their attributes
+OUTPUT_VARIABLES = {
+    'time': dict(units='seconds since 1970-01-01T00:00:00Z',
+                 long_name='Time'),
+    'calphase': dict(units='degrees', long_name='Optode calibrated phase'),
+    'optode_temperature': dict(units='degrees_Celsius',
+                               long_name='Optode temperature'),
+    'temperature': dict(units='degrees_Celsius', long_name='CTD temperature'),
+    'practical_salinity': dict(units='1', long_name='Practical salinity'),
+    'pressure': dict(units='dbar', long_name='CTD pressure'),
+    'doconcs': dict(units='umol L-1', long_name='Dissolved oxygen '
+                    'concentration, uncorrected (DOCONCS_L1)'),
+    'doxygen': dict(units='umol kg-1', long_name='Dissolved oxygen, '
+                    'salinity and pressure corrected (DOXYGEN_L2)'),
+    }
+
+
+def limit_chunk_cache(variables, chunk_size):
+    """Sizes the HDF5 chunk cache of each variable to two chunks of float64
+    records. The default of 64 MB per variable would otherwise make memory
+    grow with the length of the file until the cache fills."""
+    for var in variables:
+        var.set_var_chunk_cache(size=max(2 * chunk_size * 8, 2**20))
+
+
+def read_chunks(nc, variables, chunk_size):
+    """Yields dictionaries of float arrays holding `chunk_size` records of
+    each variable at a time, with masked values as NaN.
+
+    Parameters
+    ----------
+    nc : netCDF4.Dataset
+    variables : dict
+        Names to use for the chunk arrays, mapped to netCDF variable names.
+        Variables missing from the file are all NaN
+    chunk_size : int
+        Number of records per chunk
+    """
+    present = [var for var in variables.values() if var in nc.variables]
+    if not present:
+        return
+    limit_chunk_cache([nc[var] for var in present], chunk_size)
+    n = len(nc[present[0]])
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        yield dict(
+                (name, np.ma.filled(nc[var][start:stop].astype(float), np.nan)
+                 if var in nc.variables else np.full(stop - start, np.nan))
+                for name, var in variables.items())
+
+
+def read_files(paths, variables, chunk_size):
+    """Yields the chunks of read_chunks from each netCDF file in turn, so
+    that the per-file outputs of dbd_conversion can be processed as one
+    dataset with only one file open at a time."""
+    for path in paths:
+        with netCDF4.Dataset(path, 'r') as nc:
+            for chunk in read_chunks(nc, variables, chunk_size):
+                yield chunk
+
+
+def create_output(path, chunk_size, calibration, lat, lon, salt):
+    """Creates the output netCDF file with an unlimited time dimension, so
+    that chunks can be appended to it as they are processed."""
+    out = netCDF4.Dataset(path, 'w')
+    out.createDimension('time', None)
+    for name, attributes in OUTPUT_VARIABLES.items():
+        var = out.createVariable(name, 'f8', ('time',), zlib=True,
+                                 chunksizes=(chunk_size,),
+                                 fill_value=np.nan)
+        var.setncatts(attributes)
+    limit_chunk_cache(out.variables.values(), chunk_size)
+    out.latitude = lat
+    out.longitude = lon
+    out.optode_salinity_setting = salt
+    out.calibration = repr(calibration)
+    return out
+
+
+def process_chunk(chunk, calibration, lat, lon, salt=0.0, max_gap=60.0,
+                  final=True):
+    """Calculates oxygen for one chunk of dbd2netCDF records.
+
+    The CTD values are interpolated to the optode sample times with
+    time_alignment. Unless this is the final chunk, the optode samples after
+    the last CTD sample can't be interpolated yet, so they are handed back to
+    be processed with the next chunk, along with the CTD records needed to
+    interpolate them.
+
+    Parameters
+    ----------
+    chunk : dict
+        Arrays of the INPUT_VARIABLES, as yielded by read_chunks
+    calibration : OptodeCalibration
+    lat, lon : Scalar. [degrees]
+        Position of the glider
+    salt : Scalar, optional. [PSU]
+        The SALINITY parameter preset in the optode. Default is 0.0
+    max_gap : Scalar, optional. [seconds]
+        Longest gap between CTD samples to interpolate across. Default is 60
+    final : Bool, optional.
+        Whether this is the last chunk of the file. Default is True
+
+    Returns
+    -------
+    A tuple of the results and the carry-over.
+
+    results : dict of arrays of the OUTPUT_VARIABLES, for the records with an
+        optode sample.
+    carry : dict of arrays of the INPUT_VARIABLES to put in front of the next
+        chunk, or None for the final chunk.
+    """
+    time = chunk['time']
+    cut = np.inf
+    if not final:
+        # Optode samples after the last sample of a CTD variable wait for the
+        # next chunk, unless that sample is too long before the end of the
+        # chunk for any later sample to be interpolated with it
+        end = np.nanmax(time)
+        for name in CTD_VARIABLES:
+            sampled = time[np.isfinite(chunk[name])]
+            last = sampled.max() if len(sampled) else -np.inf
+            if last >= end - max_gap:
+                cut = min(cut, last)
+        cut = min(cut, end)
+
+    # drop the records without an optode sample and the zeros where the
+    # instrument initializes
+    keep = (np.isfinite(chunk['calphase']) & (chunk['calphase'] != 0.0)
+            & (time <= cut))
+    result = dict((name, chunk[name][keep]) for name in
+                  ('time', 'calphase', 'optode_temperature'))
+    # pressure is in bar and conductivity in S/m
+    pressure = chunk['pressure'] * 10
+    salinity = gsw.SP_from_C(chunk['conductivity'] * 10,
+                             chunk['temperature'], pressure)
+    (result['pressure'], result['temperature'],
+     result['practical_salinity']) = align_ctd(
+            result['time'], time, pressure, chunk['temperature'], salinity,
+            max_gap=max_gap)
+    result['doconcs'], result['doxygen'] = calibration.calc_o2_batch(
+            result['calphase'], result['optode_temperature'],
+            result['temperature'], result['practical_salinity'],
+            result['pressure'], lat, lon, time=result['time'], salt=salt)
+
+    if final:
+        return result, None
+    # carry the records after the cut, and the CTD records within max_gap
+    # before it (without their optode samples, which are done)
+    carry = dict((name, chunk[name][time >= cut - max_gap])
+                 for name in INPUT_VARIABLES)
+    done = carry['time'] <= cut
+    carry['calphase'] = np.where(done, np.nan, carry['calphase'])
+    return result, carry
+
+
+def stream_doxygen(input_path, output_path, calibration, lat, lon, salt=0.0,
+                   chunk_size=100000, max_gap=60.0):
+    """Processes a dbd2netCDF file into DOXYGEN_L2 chunk by chunk.
+
+    Parameters
+    ----------
+    input_path : str or list of str
+        netCDF file written by dbd2netCDF, or a list of them in time order
+        (e.g. the per-file outputs of dbd_conversion)
+    output_path : str
+        netCDF file to write the oxygen to
+    calibration : OptodeCalibration
+    lat, lon : Scalar. [degrees]
+        Position of the glider
+    salt : Scalar, optional. [PSU]
+        The SALINITY parameter preset in the optode. Default is 0.0
+    chunk_size : int, optional
+        Number of input records to process at a time. Default is 100000
+    max_gap : Scalar, optional. [seconds]
+        Longest gap between CTD samples to interpolate across. Default is 60
+
+    Returns
+    -------
+    Number of oxygen samples written.
+    """
+    if isinstance(input_path, str):
+        input_path = [input_path]
+    written = 0
+    with create_output(output_path, chunk_size, calibration, lat, lon,
+                       salt) as out:
+        carry = None
+        chunks = read_files(input_path, INPUT_VARIABLES, chunk_size)
+        chunk = next(chunks, None)
+        while chunk is not None:
+            if carry is not None:
+                chunk = dict((name, np.concatenate((carry[name], chunk[name])))
+                             for name in INPUT_VARIABLES)
+            # look ahead so the last chunk can be processed in full
+            next_chunk = next(chunks, None)
+            result, carry = process_chunk(chunk, calibration, lat, lon, salt,
+                                          max_gap, final=next_chunk is None)
+            n = len(result['time'])
+            for name in OUTPUT_VARIABLES:
+                out[name][written:written + n] = result[name]
+            written += n
+            chunk = next_chunk
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Calculates DOXYGEN_L2 from a dbd2netCDF file in "
+                        "fixed-size chunks")
+    parser.add_argument('input', nargs='+',
+                        help="netCDF file(s) written by dbd2netCDF, in time "
+                             "order")
+    parser.add_argument('output', help="netCDF file to write the oxygen to")
+    parser.add_argument('--config', required=True,
+                        help="optode calibration config json")
+    parser.add_argument('--lat', type=float, required=True,
+                        help="latitude of the glider [degrees]")
+    parser.add_argument('--lon', type=float, required=True,
+                        help="longitude of the glider [degrees]")
+    parser.add_argument('--salt', type=float, default=0.0,
+                        help="salinity setting of the optode [PSU]")
+    parser.add_argument('--max-gap', type=float, default=60.0,
+                        help="longest gap between CTD samples to interpolate "
+                             "across [seconds]")
+    parser.add_argument('--chunk-size', type=int, default=100000,
+                        help="number of records to process at a time")
+    args = parser.parse_args(argv)
+
+    calibration = OptodeCalibration.from_json(args.config)
+    written = stream_doxygen(args.input, args.output, calibration, args.lat,
+                             args.lon, salt=args.salt,
+                             chunk_size=args.chunk_size,
+                             max_gap=args.max_gap)
+    print("Wrote {:d} oxygen samples to {:s}".format(written, args.output))
+
+
+if __name__ == '__main__':
+    main()
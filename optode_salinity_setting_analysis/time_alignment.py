@@ -0,0 +1,195 @@
+"""time_alignment
+Aligns sparse glider science time series to the timestamps of another
+sensor, e.g. CTD pressure, temperature and salinity to the optode samples, so
+that they can be fed to do2_salinity_correction.
+
+Each science sensor updates at its own rate, so in the dbd2netCDF output most
+records only hold values for some of the variables. The values of a source
+variable are interpolated (or nearest-matched) onto the target times with a
+binary search over the source times, so aligning n samples costs
+O(n log n). Values are never bridged across gaps longer than `max_gap`, or
+across the turn between a dive and a climb when profile boundaries are given,
+and are never extrapolated beyond the first or last source sample.
+
+Usage
+-----
+boundaries = profile_boundaries(ctd_time, pressure)
+P, T, SP = align_ctd(oxytime, ctd_time, pressure, temperature, salinity,
+                     max_gap=60, boundaries=boundaries)
+DOc = do2_salinity_correction(DO, P, T, SP, lat, lon)
+"""
+import numpy as np
+
+
+def profile_boundaries(time, pressure, min_excursion=1.0):
+    """
+    Finds the times at which a glider turns from diving to climbing or from
+    climbing to diving.
+
+    Parameters
+    ----------
+    time : Array. [epoch seconds]
+        Sample times
+    pressure : Array. [dbar]
+        Pressure at each sample time, NaN where there is no sample
+    min_excursion : Scalar, optional. [dbar]
+        Smallest change in pressure after a turn for it to count, so that
+        noise and small wiggles at the top and bottom of a profile aren't
+        taken as turns. Default is 1.0
+
+    Returns
+    -------
+    boundaries : Array. [epoch seconds]
+        Sorted times of the turns. Samples at or after a boundary belong to
+        the next profile.
+    """
+    time = np.asarray(time, dtype=float)
+    pressure = np.asarray(pressure, dtype=float)
+    ok = np.isfinite(time) & np.isfinite(pressure)
+    time, pressure = time[ok], pressure[ok]
+    if np.any(time[1:] < time[:-1]):
+        order = np.argsort(time, kind='stable')
+        time, pressure = time[order], pressure[order]
+    if len(time) < 3:
+        return np.array([])
+
+    # Local extrema of pressure are the candidate turns: the samples where
+    # the direction of the (non-zero) pressure changes flips
+    steps = np.flatnonzero(np.diff(pressure) != 0)
+    direction = np.sign(pressure[steps + 1] - pressure[steps])
+    flips = steps[np.flatnonzero(direction[1:] != direction[:-1]) + 1]
+    extrema = np.concatenate(([0], flips, [len(pressure) - 1]))
+    values = pressure[extrema].tolist()
+
+    # Keep the extrema that are followed by at least min_excursion of travel
+    # the other way. There are far fewer extrema than samples, so this runs
+    # over the extrema only.
+    turns = []
+    anchor = 0
+    candidate = None
+    heading = 0
+    for k in range(1, len(values)):
+        if heading == 0:
+            if abs(values[k] - values[anchor]) >= min_excursion:
+                heading = 1 if values[k] > values[anchor] else -1
+                candidate = k
+        elif (values[k] - values[candidate]) * heading > 0:
+            candidate = k
+        elif abs(values[k] - values[candidate]) >= min_excursion:
+            turns.append(candidate)
+            heading = -heading
+            candidate = k
+    return time[extrema[turns]]
+
+
+def profile_index(time, boundaries):
+    """Index of the profile each sample time falls in, given the profile
+    boundaries from profile_boundaries."""
+    return np.searchsorted(boundaries, time, side='right')
+
+
+def align(target_time, source_time, values, method='linear', max_gap=None,
+          boundaries=None):
+    """
+    Aligns a sparse time series to target times.
+
+    Parameters
+    ----------
+    target_time : Array. [epoch seconds]
+        Times to align the values to, e.g. the optode sample times
+    source_time : Array. [epoch seconds]
+        Times of the source series
+    values : Array.
+        Source values, NaN where the sensor has no sample
+    method : 'linear' or 'nearest', optional.
+        Interpolate linearly between the source samples either side of each
+        target time, or take the value of the closest source sample. Default
+        is 'linear'
+    max_gap : Scalar, optional. [seconds]
+        For 'linear', the longest time between the two source samples that
+        may be interpolated between. For 'nearest', the longest time between
+        a target time and the source sample matched to it. Default is no limit
+    boundaries : Array, optional. [epoch seconds]
+        Profile boundaries from profile_boundaries. Source samples are only
+        used for target times in the same profile
+
+    Returns
+    -------
+    aligned : Array.
+        The source values at the target times, NaN where there is no source
+        sample close enough.
+    """
+    if method not in ('linear', 'nearest'):
+        raise ValueError("method must be 'linear' or 'nearest', not %r"
+                         % method)
+    target_time = np.asarray(target_time, dtype=float)
+    source_time = np.asarray(source_time, dtype=float)
+    values = np.asarray(values, dtype=float)
+    aligned = np.full(target_time.shape, np.nan)
+
+    ok = np.isfinite(source_time) & np.isfinite(values)
+    source_time, values = source_time[ok], values[ok]
+    if np.any(source_time[1:] < source_time[:-1]):
+        order = np.argsort(source_time, kind='stable')
+        source_time, values = source_time[order], values[order]
+    n = len(source_time)
+    if n == 0:
+        return aligned
+
+    # the source samples at or after (right) and before (left) each target
+    right = np.searchsorted(source_time, target_time, side='left')
+    left = right - 1
+    has_right = right < n
+    has_left = left >= 0
+    right = np.minimum(right, n - 1)
+    left = np.maximum(left, 0)
+    dt_right = source_time[right] - target_time
+    dt_left = target_time - source_time[left]
+
+    if method == 'linear':
+        exact = has_right & (dt_right == 0)
+        usable = has_left & has_right & ~exact
+        if max_gap is not None:
+            usable &= source_time[right] - source_time[left] <= max_gap
+        if boundaries is not None:
+            profile = profile_index(source_time, boundaries)
+            usable &= profile[left] == profile[right]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = dt_left / (source_time[right] - source_time[left])
+            interpolated = (values[left]
+                            + weight * (values[right] - values[left]))
+        aligned[usable] = interpolated[usable]
+        aligned[exact] = values[right[exact]]
+        return aligned
+
+    # nearest: rule out the neighbours that are missing, too far away or in
+    # another profile, then take the closer of the two that remain
+    dt_right = np.where(has_right, dt_right, np.inf)
+    dt_left = np.where(has_left, dt_left, np.inf)
+    if max_gap is not None:
+        dt_right[dt_right > max_gap] = np.inf
+        dt_left[dt_left > max_gap] = np.inf
+    if boundaries is not None:
+        profile = profile_index(source_time, boundaries)
+        target_profile = profile_index(target_time, boundaries)
+        dt_right[profile[right] != target_profile] = np.inf
+        dt_left[profile[left] != target_profile] = np.inf
+    nearest = np.where(dt_left <= dt_right, left, right)
+    found = np.isfinite(np.minimum(dt_left, dt_right))
+    aligned[found] = values[nearest[found]]
+    return aligned
+
+
+def align_ctd(target_time, ctd_time, pressure, temperature, salinity,
+              method='linear', max_gap=None, boundaries=None):
+    """
+    Aligns CTD pressure, temperature and salinity to the optode sample times,
+    ready for do2_salinity_correction. See align for the parameters.
+
+    Returns
+    -------
+    A tuple of P, T and SP at the target times.
+    """
+    return tuple(align(target_time, ctd_time, values, method=method,
+                       max_gap=max_gap, boundaries=boundaries)
+                 for values in (pressure, temperature, salinity))